@@ -29,7 +29,7 @@ lc = interp.LightCurve(tms, isper)
 lcn = lc.Realize(ra, dec, filtstr=filtstr, doAddErr = True, doDith = False, version="OpSim3_61")
 #Available versions are: OpSim3_61, opsim1_29, opsim5_72, and cronos92
 #If you wish to use the older version of the catalog, set the version to "Cronos92".
-#Dithering can currently only be done on the older version.
+#Dithering (doDith = True) may be used with any version.
 #NOTE:  If resultant magerr = -9999 the m5 was brighter than the interpolated magnitude
 timeres = []
 for i in range(len(ra)):
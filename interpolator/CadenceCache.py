@@ -0,0 +1,150 @@
+''' Least recently used cache of cadences in front of a source of time sampling.
+    CadenceCache wraps a DB or PointingStore and has the same getTimeMagSQL, getTimeMagBatch and
+    getTimeMagFilterBatch contract, so it may be passed to LightCurve.Realize in their place.  Cadences are keyed by
+    (ra, dec, filter, doDith, version) and kept as read only arrays, so the same arrays may be shared
+    by every model realized at a position.  Keep one CadenceCache per process and pass it to each
+    call of Realize to reuse cadences across calls.
+'''
+from collections import OrderedDict
+import threading
+import numpy as num
+from DB import packCadences, _uniqueFilters
+
+class CadenceCache:
+    ''' Class for caching the time sampling returned by a DB or PointingStore '''
+    def __init__(self, db, maxsize=100000):
+        '''
+        Construct a cache in front of db
+        Inputs:
+        db -- source of the time sampling with getTimeMagSQL and getTimeMagBatch methods
+        maxsize -- maximum number of cadences to hold; the least recently used are evicted first
+        '''
+        self.db = db
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        #Guards the cache, not the wrapped source, so Realize's prefetch threads may share it
+        self._lock = threading.RLock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *dumArgs):
+        self.close()
+
+    def close(self):
+        '''Close the wrapped source of time sampling; the cached cadences are kept'''
+        self.db.close()
+
+    def isOpen(self):
+        return self.db.isOpen()
+
+    def __getstate__(self):
+        #The cached cadences stay with this process; an unpickled cache starts empty
+        return {'db': self.db, 'maxsize': self.maxsize}
+
+    def __setstate__(self, state):
+        self.__init__(state['db'], state['maxsize'])
+
+    def clear(self):
+        '''Drop all cached cadences'''
+        self._cache.clear()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def _key(self, ra, dec, filt, doDith, version):
+        return (float(ra), float(dec), filt, bool(doDith), version.lower())
+
+    def _get(self, key):
+        #Move the entry to the most recently used end; returns None if not cached
+        with self._lock:
+            value = self._cache.pop(key, None)
+            if value is not None:
+                self._cache[key] = value
+            return value
+
+    def _put(self, key, time, m5):
+        time = num.array(time, dtype=float)
+        m5 = num.array(m5, dtype=float)
+        time.flags.writeable = False
+        m5.flags.writeable = False
+        with self._lock:
+            self._cache[key] = (time, m5)
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return time, m5
+
+    def getTimeMagSQL(self, ra, dec, filt, doDith=False, version="opsim3_61"):
+        ''' Retrieve timing for a single ra/dec pair, from the cache if possible.  See DB.getTimeMagSQL '''
+        key = self._key(ra, dec, filt, doDith, version)
+        value = self._get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        time, m5 = self.db.getTimeMagSQL(ra, dec, filt, doDith, version)
+        return self._put(key, time, m5)
+
+    def getTimeMagBatch(self, ras, decs, filt, doDith=False, version="opsim3_61"):
+        ''' Retrieve timing for a sequence of ra/dec pairs, fetching only the positions not already
+            cached in one batch from the wrapped source.  See DB.getTimeMagBatch
+        '''
+        assert len(ras) == len(decs), "ra and dec arrays must be the same length"
+        keys = [self._key(ra, dec, filt, doDith, version) for ra, dec in zip(ras, decs)]
+        cadences = [None]*len(keys)
+        missing = []
+        for i, key in enumerate(keys):
+            cadences[i] = self._get(key)
+            if cadences[i] is None:
+                missing.append(i)
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            #Repeated positions are fetched once
+            unique = OrderedDict()
+            for i in missing:
+                unique.setdefault(keys[i], i)
+            idx = unique.values()
+            time, m5, offsets = self.db.getTimeMagBatch([ras[i] for i in idx], [decs[i] for i in idx], filt, doDith, version)
+            fetched = {}
+            for j, key in enumerate(unique.keys()):
+                fetched[key] = self._put(key, time[offsets[j]:offsets[j+1]], m5[offsets[j]:offsets[j+1]])
+            for i in missing:
+                cadences[i] = fetched[keys[i]]
+        return packCadences(cadences)
+
+    def getTimeMagFilterBatch(self, ras, decs, filts, doDith=False, version="opsim3_61"):
+        ''' Retrieve timing for a sequence of ra/dec pairs in several filters.  Positions missing any of the
+            filters from the cache are fetched in all of them with one getTimeMagFilterBatch of the wrapped
+            source.  See DB.getTimeMagFilterBatch
+        '''
+        assert len(ras) == len(decs), "ra and dec arrays must be the same length"
+        filts = _uniqueFilters(filts)
+        cadences = dict([(f, [None]*len(ras)) for f in filts])
+        missing = []
+        for i, (ra, dec) in enumerate(zip(ras, decs)):
+            for f in filts:
+                cadences[f][i] = self._get(self._key(ra, dec, f, doDith, version))
+            if any([cadences[f][i] is None for f in filts]):
+                missing.append(i)
+        self.hits += (len(ras) - len(missing))*len(filts)
+        self.misses += len(missing)*len(filts)
+        if missing:
+            #Repeated positions are fetched once
+            unique = OrderedDict()
+            for i in missing:
+                unique.setdefault(self._key(ras[i], decs[i], None, doDith, version), i)
+            idx = unique.values()
+            fetched = self.db.getTimeMagFilterBatch([ras[i] for i in idx], [decs[i] for i in idx], filts, doDith, version)
+            byKey = {}
+            for f in filts:
+                time, m5, offsets = fetched[f]
+                for j, i in enumerate(idx):
+                    key = self._key(ras[i], decs[i], f, doDith, version)
+                    byKey[key] = self._put(key, time[offsets[j]:offsets[j+1]], m5[offsets[j]:offsets[j+1]])
+            for i in missing:
+                for f in filts:
+                    cadences[f][i] = byKey[self._key(ras[i], decs[i], f, doDith, version)]
+        return dict([(f, packCadences(cadences[f])) for f in filts])
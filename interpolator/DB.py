@@ -2,25 +2,230 @@
     The constructor connects to the default database and returns a cursor to the database.
     The getTimeMagSQL takes a filter, ra/dec pair, and a boolean to which determines whether
     to query the original cronos.92 pointings or the dithered ones.
+    getTimeMagBatch loads the positions of a batch into a temporary table and fetches the sampling of all
+    of them with one query joining it against the pointing centers.
+    getTimeMagFilterSQL and getTimeMagFilterBatch fetch the sampling in several filters with one query,
+    for one position or a whole batch respectively, and split it by filter afterwards.
+    A DB may connect to another server, or to a local SQLite stand-in through SQLiteConnect, by
+    passing a connection factory to the constructor.  The covering pointings are found among the
+    distinct field (or dithered) centers of a run, which each query groups out of the run table unless
+    the run is listed in centerTables, in which case they are read from the <run table>_fieldcenters and
+    <run table>_hexdithcenters tables.  createCenterTables creates those, once, as an administrative
+    step; connections, pools and workers only read them.  DBPool shares a bounded number of DB
+    connections between threads.
     Created September 24 2007 by K. Simon Krughoff University of Washington.
     Modified:
     March 2009 by K. Simon Krughoff krughoff@astro.washington.edu
 '''
 import MySQLdb
+import sqlite3
+import threading
+import Queue
 import numpy as num
 import math
+
+def getRunTable(version):
+    ''' Map an operation simulator version onto the table holding its pointings
+    Inputs:
+    - version: Version of the operation simulator.  Currently, there are four: Cronos92 (old), OpSim5_72, OpSim1_29 and OpSim3_61 (new).
+    Return:
+    - simtab: name of the table of pointings for the run
+    - m5col: name of the column holding the 5 sigma limiting magnitude in that table
+    '''
+    lversion = version.lower()
+    m5col = ""
+    simtab = ""
+    if(lversion == "cronos92"):
+        m5col = "m5"
+        simtab = "pointing_meta"
+    elif(lversion == "opsim5_72"):
+        m5col = "5sigma_ps"
+        simtab = "output_opsim5_72"
+    elif(lversion == "opsim1_29"):
+        m5col = "5sigma_ps"
+        simtab = "output_opsim1_29"
+    elif(lversion == "opsim3_61"):
+        m5col = "5sigma_ps"
+        simtab = "output_opsim3_61"
+    else:
+        m5col = "5sigma_ps"
+        simtab = "output_opsim3_61"
+        print "Didn't recognize the run name (%s).  Setting to latest: OpSim3_61"%version
+    return simtab, m5col
+
+def packCadences(cadences):
+    ''' Pack a list of (time, m5) cadences into flat arrays with per position offsets
+    Inputs:
+    - cadences: sequence of (time, m5) pairs as returned by getTimeMagSQL
+    Return:
+    - time: the times of all cadences, concatenated
+    - m5: the 5 sigma limiting magnitudes of all cadences, concatenated
+    - offsets: array of len(cadences)+1 offsets; cadence i is time[offsets[i]:offsets[i+1]]
+    '''
+    offsets = num.zeros(len(cadences) + 1, dtype=int)
+    offsets[1:] = num.cumsum([len(c[0]) for c in cadences])
+    if len(cadences) == 0:
+        return num.zeros(0), num.zeros(0), offsets
+    time = num.concatenate([num.asarray(c[0], dtype=float) for c in cadences])
+    m5 = num.concatenate([num.asarray(c[1], dtype=float) for c in cadences])
+    return time, m5, offsets
+
+def partitionFilters(time, m5, filtcol, filts):
+    ''' Split time ordered epochs in several filters into one cadence per filter
+    Inputs:
+    - time: the simulated observations in MJD
+    - m5: the 5 sigma limiting magnitude associated with each observation
+    - filtcol: the filter of each observation
+    - filts: the filters to return; epochs in other filters are dropped
+    Return:
+    - dictionary of (time, m5) cadences keyed by filter, each in the order of the input
+    '''
+    time = num.asarray(time, dtype=float)
+    m5 = num.asarray(m5, dtype=float)
+    code = dict([(f, k) for k, f in enumerate(filts)])
+    codes = num.array([code.get(f, -1) for f in filtcol], dtype=int)
+    #The stable sort groups the epochs by filter keeping each group in time order
+    order = num.argsort(codes, kind='mergesort')
+    bounds = num.searchsorted(codes[order], num.arange(len(filts) + 1))
+    cadences = {}
+    for k, f in enumerate(filts):
+        rows = order[bounds[k]:bounds[k+1]]
+        cadences[f] = (time[rows], m5[rows])
+    return cadences
+
+def packFilterCadences(cadences, filts):
+    ''' Pack a list of per position dictionaries of (time, m5) cadences keyed by filter into a dictionary
+        of (time, m5, offsets) keyed by filter, see packCadences
+    '''
+    return dict([(f, packCadences([c[f] for c in cadences])) for f in filts])
+
+def splitPositions(pos, time, m5, npos):
+    ''' Pack the rows of a batch query, sorted by position, into the (time, m5, offsets) of packCadences
+    Inputs:
+    - pos: index of the position of each row
+    - time, m5: the epoch and 5 sigma limiting magnitude of each row
+    - npos: number of positions of the batch
+    '''
+    offsets = num.zeros(npos + 1, dtype=int)
+    offsets[1:] = num.cumsum(num.bincount(num.asarray(pos, dtype=int), minlength=npos))
+    return num.asarray(time, dtype=float), num.asarray(m5, dtype=float), offsets
+
+def _uniqueFilters(filts):
+    #Filters in order of first appearance
+    unique = []
+    for f in filts:
+        if f not in unique:
+            unique.append(f)
+    return unique
+
+def _acos(x):
+    #Rounding can push the dot product of coincident positions just past 1
+    return math.acos(max(-1., min(1., x)))
+
+def _centerPrefix(doDith):
+    #Prefix of the columns holding the pointing centers, undithered or dithered
+    if doDith:
+        return "hexdith"
+    return "field"
+
+def getCenterTable(simtab, doDith=False):
+    ''' Name of the table of distinct pointing centers of the run table simtab, see DB.createCenterTables '''
+    return "%s_%scenters"%(simtab, _centerPrefix(doDith))
+
+def _coneBox(ra, dec, pointing_radius_deg=1.75):
+    ''' Box around the pointings that may cover a position, see DB.getConeQuery
+    Inputs:
+    - ra, dec: position in degrees
+    Return:
+    - ra, dec: the position with RA wrapped into [0, 360] and declination clipped to [-90, 90]
+    - declims: (min, max) declination of the box in radians
+    - ralims: list of one or two (min, max) RA intervals of the box in radians
+    '''
+    if ra < 0 or ra > 360.:
+        ra = ra%360.
+    if dec > 90:
+       dec = 90.
+    if dec < -90:
+       dec = -90.
+    deg2rad = math.pi/180.0
+    #draw box around the pointing
+    decmin = dec - pointing_radius_deg;
+    decmax = dec + pointing_radius_deg;
+    if decmin < -90:
+        decmin = -90.
+    if decmax > 90:
+        decmax = 90.
+    declims = (decmin*deg2rad, decmax*deg2rad)
+
+    decorr = decmin
+    if math.fabs(decmin) > math.fabs(decmax):
+        decorr = decmin
+    else:
+        decorr = decmax
+    ralims = []
+    if math.fabs(decorr) >= 90.:
+        ralims = [(0.*deg2rad, 360.*deg2rad)]
+    else:
+        ramin = ra - pointing_radius_deg/math.cos(decorr*deg2rad)
+        ramax = ra + pointing_radius_deg/math.cos(decorr*deg2rad) 
+        if ramin < 0 and ramax > 360:
+            ralims = [(0.*deg2rad, 360.*deg2rad)]
+        elif ramin < 0:
+            ralims.append(((360.+ ramin)*deg2rad, 360.*deg2rad))
+            ralims.append((0.*deg2rad, ramax*deg2rad))
+        elif ramax > 360:
+            ralims.append((0.*deg2rad, (ramax - 360)*deg2rad))
+            ralims.append((ramin*deg2rad, 360.*deg2rad))
+        else:
+            ralims = [(ramin*deg2rad, ramax*deg2rad)]
+    return ra, dec, declims, ralims
+
+class SQLiteConnect:
+    ''' Connection factory for a local SQLite stand-in of the pointings database.
+        The trigonometric functions used by the cone search queries are registered on each connection.
+    '''
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+
+    def __call__(self):
+        conn = sqlite3.connect(self.dbfile, check_same_thread=False)
+        conn.create_function("acos", 1, _acos)
+        conn.create_function("sin", 1, math.sin)
+        conn.create_function("cos", 1, math.cos)
+        return conn
+
 class DB:
     ''' Class for handling database connections '''
     host = "lsst-db.astro.washington.edu"
     user = "lsst"
     passwd = "lsst"
     dbase = "lsst_pointings"
-    def __init__(self):
+    def __init__(self, connect=None, centerTables=None):
+        '''
+        Connect to the database
+        Inputs:
+        connect -- callable returning a DB-API connection, e.g. SQLiteConnect(dbfile).
+                   If None, connect to the default MySQL database.
+        centerTables -- versions whose covering pointings are looked up in tables of their distinct
+                        centers.  The tables are not created here; createCenterTables must have been
+                        run once against the database beforehand.
+        '''
+        self._connect = connect
+        #Run tables, and the versions naming them, with center tables
+        self._centerTables = set()
+        self._centerVersions = []
         self.__enter__()
+        for version in centerTables or []:
+            self.useCenterTables(version)
 
     def __enter__(self):
-        self.db = MySQLdb.connect(host=self.host, user=self.user, passwd=self.passwd, db=self.dbase)
+        if self._connect is None:
+            self.db = MySQLdb.connect(host=self.host, user=self.user, passwd=self.passwd, db=self.dbase)
+        else:
+            self.db = self._connect()
         self.cursor = self.db.cursor()
+        #A connection serves one query at a time
+        self._lock = threading.Lock()
         return self
 
     def __exit__(self, *dumArgs):
@@ -34,9 +239,35 @@ class DB:
         '''Close the db connection; may be safely called even if already closed'''
         self.__exit__()
 
+    def __getstate__(self):
+        #Connections cannot be shared between processes; an unpickled DB opens its own
+        return {'connect': self._connect, 'centerTables': self._centerVersions}
+
+    def __setstate__(self, state):
+        self.__init__(state['connect'], state.get('centerTables'))
+
     def isOpen(self):
         return self.db != None
    
+    def getTimeMagBatch(self, ras, decs, filt, doDith=False, version="opsim3_61"):
+        ''' Retrieve timing from default database for a sequence of ra/dec pairs in a particular filter with one
+            query, see getBatchQuery.
+        Inputs:
+        - ras: a sequence of RA positions in degrees
+        - decs: a sequence of declination positions in degrees
+        - filt, doDith, version: as for getTimeMagSQL
+        Return:
+        - time: the simulated observations in MJD of all positions, concatenated
+        - m5: the 5 sigma limiting magnitude associated with each observation, concatenated
+        - offsets: array of len(ras)+1 offsets; the cadence of position i is time[offsets[i]:offsets[i+1]]
+        '''
+        assert len(ras) == len(decs), "ra and dec arrays must be the same length"
+        result = self.executeBatch(ras, decs, "filter = \'%s\'"%(filt), doDith, version)
+        if len(result) == 0:
+            return packCadences([([], [])]*len(ras))
+        pos, time, m5 = zip(*result)
+        return splitPositions(pos, time, m5, len(ras))
+
     def getTimeMagSQL(self, ra, dec, filt, doDith=False, version="opsim3_61"):
         ''' Retrieve timing from default database for a single ra/dec pair in a particular filter from
             any of the OpSim runs.
@@ -50,111 +281,335 @@ class DB:
         - time: a sequence of simulated observation in MJD
         - m5: a sequence of the 5 sigma limiting magnitude associated with each observation
         '''
-        lversion = version.lower()
-        m5col = ""
-        simtab = ""
-        if(lversion == "cronos92"):
-            m5col = "m5"
-            simtab = "pointing_meta"
-        elif(lversion == "opsim5_72"):
-            m5col = "5sigma_ps"
-            simtab = "output_opsim5_72"
-        elif(lversion == "opsim1_29"):
-            m5col = "5sigma_ps"
-            simtab = "output_opsim1_29"
-        elif(lversion == "opsim3_61"):
-            m5col = "5sigma_ps"
-            simtab = "output_opsim3_61"
+        query = self.getConeQuery(ra, dec, "filter = \'%s\'"%(filt), doDith, version)
+        #Execute query and return all results
+        result = self.execute(query)
+        #Check if query returns.  If not, return empty arrays.
+        if len(result) == 0:
+            time = num.asarray([])
+            m5 = num.asarray([])
+        else:
+            #Read results into arrays.  The star is very important.
+            time, m5 = zip(*result)
+            time = num.asarray(time)
+            m5 = num.asarray(m5)
+        return time, m5
+
+    def getTimeMagFilterSQL(self, ra, dec, filts, doDith=False, version="opsim3_61"):
+        ''' Retrieve timing from default database for a single ra/dec pair in several filters with one query.
+        Inputs:
+        - ra, dec, doDith, version: as for getTimeMagSQL
+        - filts: a sequence of filter strings
+        Return:
+        - dictionary of (time, m5) keyed by filter, each as getTimeMagSQL would return for that filter
+        '''
+        filts = _uniqueFilters(filts)
+        filtstr = ", ".join(["\'%s\'"%(f) for f in filts])
+        query = self.getConeQuery(ra, dec, "filter in (%s)"%(filtstr), doDith, version, withFilter=True)
+        result = self.execute(query)
+        if len(result) == 0:
+            return partitionFilters([], [], [], filts)
+        time, m5, filtcol = zip(*result)
+        return partitionFilters(time, m5, filtcol, filts)
+
+    def getTimeMagFilterBatch(self, ras, decs, filts, doDith=False, version="opsim3_61"):
+        ''' Retrieve timing from default database for a sequence of ra/dec pairs in several filters with one
+            query, see getBatchQuery.
+        Inputs:
+        - ras, decs, doDith, version: as for getTimeMagBatch
+        - filts: a sequence of filter strings
+        Return:
+        - dictionary of (time, m5, offsets) keyed by filter, each as getTimeMagBatch would return for that filter
+        '''
+        assert len(ras) == len(decs), "ra and dec arrays must be the same length"
+        filts = _uniqueFilters(filts)
+        filtstr = ", ".join(["\'%s\'"%(f) for f in filts])
+        result = self.executeBatch(ras, decs, "filter in (%s)"%(filtstr), doDith, version, withFilter=True)
+        if len(result) == 0:
+            return packFilterCadences([partitionFilters([], [], [], filts)]*len(ras), filts)
+        pos, time, m5, filtcol = zip(*result)
+        pos = num.asarray(pos, dtype=int)
+        time = num.asarray(time, dtype=float)
+        m5 = num.asarray(m5, dtype=float)
+        code = dict([(f, k) for k, f in enumerate(filts)])
+        codes = num.array([code.get(f, -1) for f in filtcol], dtype=int)
+        #The rows of each filter keep their order by position and time
+        packed = {}
+        for k, f in enumerate(filts):
+            rows = codes == k
+            packed[f] = splitPositions(pos[rows], time[rows], m5[rows], len(ras))
+        return packed
+
+    def execute(self, query):
+        ''' Execute a query and return all rows '''
+        with self._lock:
+            self.cursor.execute(query)
+            return self.cursor.fetchall()
+
+    def executeBatch(self, ras, decs, filterpred, doDith=False, version="opsim3_61", withFilter=False):
+        ''' Load the positions of a batch into the temporary table batchpos and return all rows of the batch
+            query over them, see getBatchQuery
+        '''
+        if len(ras) == 0:
+            return []
+        values = []
+        decmin, decmax = math.pi, -math.pi
+        for k, (ra, dec) in enumerate(zip(ras, decs)):
+            ra, dec, declims, ralims = _coneBox(ra, dec)
+            #A box with one RA interval repeats it
+            ralims = (ralims*2)[:2]
+            decmin = min(decmin, declims[0])
+            decmax = max(decmax, declims[1])
+            #Formatted as the constants of getConeQuery so the batch selects exactly the same pointings
+            values.append("(%d, %f, %f, %f, %f, %f, %f, %f, %f)"%((k, ra, dec) + declims + ralims[0] + ralims[1]))
+        with self._lock:
+            self.cursor.execute("create temporary table batchpos (pos integer, pra double, pdec double, decmin double, decmax double, "
+                                "ra1min double, ra1max double, ra2min double, ra2max double)")
+            try:
+                for lo in range(0, len(values), 500):
+                    self.cursor.execute("insert into batchpos values %s"%(", ".join(values[lo:lo+500])))
+                self.cursor.execute(self.getBatchQuery(filterpred, doDith, version, withFilter, (decmin, decmax)))
+                return self.cursor.fetchall()
+            finally:
+                self.cursor.execute("drop table batchpos")
+
+    def getBatchQuery(self, filterpred, doDith=False, version="opsim3_61", withFilter=False, declims=(-math.pi, math.pi)):
+        ''' Build the query for the epochs of the pointings covering every position of the batchpos table at once.
+            Each position is joined with the centers inside its box and cone exactly as by getConeQuery.
+        Inputs:
+        - filterpred, doDith, version, withFilter: as for getConeQuery
+        - declims: (min, max) declination in radians of all boxes of the batch, limiting the centers grouped
+                   out of the run table when it has no center tables
+        Return:
+        - query string selecting distinct (position, expMJD, m5[, filter]) rows ordered by position and expMJD
+        '''
+        simtab, m5col = getRunTable(version)
+        selectcols = "distinct t.pos, b.expMJD, b.`%s`"%(m5col)
+        if withFilter:
+            selectcols += ", b.filter"
+        pointing_radius_rad = 1.75*math.pi/180.0
+        deg2rad = math.pi/180.0
+        piover2 = math.pi/2.0
+        p = _centerPrefix(doDith)
+        queryparts = []
+        #cross join keeps SQLite from scanning the exposures of the run for every position; to MySQL it is a plain join
+        queryparts.append("select %s from batchpos t cross join "%(selectcols))
+        if simtab in self._centerTables:
+            queryparts.append("%s a cross join "%(getCenterTable(simtab, doDith)))
         else:
-            m5col = "5sigma_ps"
-            simtab = "output_opsim3_61"
-            print "Didn't recognize the run name (%s).  Setting to latest: OpSim3_61"%version
+            queryparts.append("(select %sra, %sdec from %s where %sdec between %f and %f group by %sra, %sdec) a cross join "%(p, p, simtab, p, declims[0], declims[1], p, p))
+        queryparts.append("%s b where a.%sdec between t.decmin and t.decmax and "%(simtab, p))
+        queryparts.append("(a.%sra between t.ra1min and t.ra1max or a.%sra between t.ra2min and t.ra2max) and acos("%(p, p))
+        queryparts.append("sin(%f - a.%sdec)*cos(a.%sra)*sin(%f - %f*(t.pdec))*cos(%f*t.pra) + "%(piover2, p, p, piover2, deg2rad, deg2rad))
+        queryparts.append("sin(%f - a.%sdec)*sin(a.%sra)*sin(%f - %f*(t.pdec))*sin(%f*t.pra) + "%(piover2, p, p, piover2, deg2rad, deg2rad))
+        queryparts.append("cos(%f - a.%sdec)*cos(%f - %f*t.pdec) "%(piover2, p, piover2, deg2rad))
+        queryparts.append(")< %f and "%(pointing_radius_rad))
+        queryparts.append("a.%sra = b.%sra and a.%sdec = b.%sdec and %s order by t.pos, b.expMJD"%(p, p, p, p, filterpred))
+        return "".join(queryparts)
+
+    def hasTable(self, table):
+        ''' True if the database holds table '''
+        with self._lock:
+            try:
+                self.cursor.execute("select 1 from %s limit 1"%(table))
+                self.cursor.fetchall()
+            except (MySQLdb.Error, sqlite3.Error):
+                return False
+        return True
+
+    def _createIfMissing(self, statement):
+        #Run a create statement, tolerating an object created meanwhile, or earlier, by another connection
+        with self._lock:
+            try:
+                self.cursor.execute(statement)
+                self.db.commit()
+            except (MySQLdb.Error, sqlite3.Error), e:
+                #MySQL reports an existing table as error 1050 and an existing index as 1061
+                if e.args[:1] not in [(1050,), (1061,)] and 'already exists' not in str(e).lower():
+                    raise
+                return False
+        return True
+
+    def createCenterTables(self, version="opsim3_61"):
+        '''
+        Precompute the distinct field and dithered centers of a run into tables of their own, with the
+        indexes used to search them, and look up the covering pointings of the run in them from now on.
+        With the tables the dithered and undithered queries cost the same; without them every query
+        groups the run table.  This is a one time administrative step: every table and index is created
+        if missing, so it may be run again to complete an interrupted run, and other connections then
+        read the tables by passing the version in centerTables.
+        Inputs:
+        - version: Version of the operation simulator, see getRunTable
+        Return:
+        - names of the undithered and dithered center tables
+        '''
+        simtab, m5col = getRunTable(version)
+        tables = []
+        for doDith in (False, True):
+            prefix = _centerPrefix(doDith)
+            table = getCenterTable(simtab, doDith)
+            self._createIfMissing("create table %s as select %sra, %sdec from %s group by %sra, %sdec"%(table, prefix, prefix, simtab, prefix, prefix))
+            #The box cut on the centers and the join back onto the exposures of the run
+            self._createIfMissing("create index %s_dec on %s (%sdec)"%(table, table, prefix))
+            self._createIfMissing("create index %s_%s on %s (%sra, %sdec)"%(simtab, prefix, simtab, prefix, prefix))
+            tables.append(table)
+        self.useCenterTables(version)
+        return tables
+
+    def useCenterTables(self, version="opsim3_61"):
+        ''' Look up the covering pointings of a run in its center tables, created by createCenterTables '''
+        simtab, m5col = getRunTable(version)
+        if simtab not in self._centerTables:
+            self._centerTables.add(simtab)
+            self._centerVersions.append(version)
+
+    def getConeQuery(self, ra, dec, filterpred, doDith=False, version="opsim3_61", withFilter=False):
+        ''' Build the query for the epochs of the pointings covering a single ra/dec pair
+        Inputs:
+        - ra, dec, doDith, version: as for getTimeMagSQL
+        - filterpred: SQL predicate on the filter column selecting the epochs
+        - withFilter: True to select the filter of each epoch as a third column
+        Return:
+        - query string selecting distinct (expMJD, m5[, filter]) rows ordered by expMJD
+        '''
+        simtab, m5col = getRunTable(version)
+        selectcols = "distinct(b.expMJD), b.`%s`"%(m5col)
+        if withFilter:
+            selectcols += ", b.filter"
            
-        if ra < 0 or ra > 360.:
-            ra = ra%360.
-        if dec > 90:
-           dec = 90.
-        if dec < -90:
-           dec = -90.
-        time = []
-        #List to contain the time sampling
-        m5 = []
-        #List to contain the 5 sigma limiting magnitudes for the pointings
+        ra, dec, declims, ralims = _coneBox(ra, dec)
         queryparts = []
         pointing_radius_deg = 1.75
         deg2rad = math.pi/180.0
-        rad2deg = 180.0/math.pi
         #Constant to convert degrees to radians
         pointing_radius_rad = pointing_radius_deg*deg2rad
-
         piover2 = math.pi/2.0
-        #draw box around the pointing
-        decmin = dec - pointing_radius_deg;
-        decmax = dec + pointing_radius_deg;
-        if decmin < -90:
-            decmin = -90.
-        if decmax > 90:
-            decmax = 90.
-        declimstr = "between %f and %f"%(decmin*deg2rad,decmax*deg2rad)
+        declimstr = "between %f and %f"%declims
+        ralimstr = ["between %f and %f"%lims for lims in ralims]
 
-        decorr = decmin
-        if math.fabs(decmin) > math.fabs(decmax):
-            decorr = decmin
-        else:
-            decorr = decmax
-        ralimstr = []
-        if math.fabs(decorr) >= 90.:
-            ralimstr = ["between %f and %f"%(0.*deg2rad, 360.*deg2rad)]
+        #Query string to do the 3 space dot product of the pointing specified by ra/dec and all field centers,
+        #or all dithered centers if doDith.
+        #Selects all centers within 0.03054/deg2rad = 1.74981 degrees of the ra/dec pair
+        p = _centerPrefix(doDith)
+        ralimstr = (" or %sra "%(p)).join(ralimstr)
+        queryparts.append("select %s from (select a.* from "%(selectcols))
+        if simtab in self._centerTables:
+            queryparts.append("(select %sra, %sdec from %s where %sdec %s and (%sra %s)) a where "%(p, p, getCenterTable(simtab, doDith), p, declimstr, p, ralimstr))
         else:
-            ramin = ra - pointing_radius_deg/math.cos(decorr*deg2rad)
-            ramax = ra + pointing_radius_deg/math.cos(decorr*deg2rad) 
-            if ramin < 0 and ramax > 360:
-                ralimstr = [ "between %f and %f"%(0.*deg2rad, 360.*deg2rad) ]
-            elif ramin < 0:
-                ralimstr.append("between %f and %f"%((360.+ ramin)*deg2rad, 360.*deg2rad))
-                ralimstr.append("between %f and %f"%(0.*deg2rad, ramax*deg2rad))
-            elif ramax > 360:
-                ralimstr.append("between %f and %f"%(0.*deg2rad, (ramax - 360)*deg2rad))
-                ralimstr.append("between %f and %f"%(ramin*deg2rad, 360.*deg2rad))
-            else:
-                ralimstr = [ "between %f and %f"%(ramin*deg2rad, ramax*deg2rad) ]
-
-        if doDith:
-            ralimstr = " or hexdithra ".join(ralimstr)
-            queryparts.append("select distinct(b.expMJD), b.%s from (select a.* from "%(m5col))
-            queryparts.append("(select hexdithra, hexdithdec from %s where hexdithdec %s and (hexdithra %s) group by hexdithra, hexdithdec) a where "%(simtab, declimstr, ralimstr))
-            queryparts.append("acos(")
-            queryparts.append("sin(%f - hexdithdec)*cos(hexdithra)*sin(%f - %f*(%f))*cos(%f*%f) + "%(piover2, piover2, deg2rad, dec, deg2rad, ra))
-            queryparts.append("sin(%f - hexdithdec)*sin(hexdithra)*sin(%f - %f*(%f))*sin(%f*%f) + "%(piover2, piover2, deg2rad, dec, deg2rad, ra))
-            queryparts.append("cos(%f - hexdithdec)*cos(%f - %f*%f) "%(piover2, piover2, deg2rad, dec))
-            queryparts.append(")< %f) a, %s b where "%(pointing_radius_rad, simtab))
-            queryparts.append("a.hexdithra = b.hexdithra and a.hexdithdec = b.hexdithdec and filter = \'%s\' order by b.expMJD"%(filt))
-            #Query string to do the 3 space dot product of the pointing specified by ra/dec and all nondithered field centers.
-            #Selects all field centers within 0.03054/deg2rad = 1.74981 degrees of the ra/dec pair
-        else:
-            ralimstr = " or fieldra ".join(ralimstr)
-            queryparts.append("select distinct(b.expMJD), b.%s from (select a.* from "%(m5col))
-            queryparts.append("(select fieldra, fielddec from %s where fielddec %s and (fieldra %s) group by fieldra, fielddec) a where "%(simtab, declimstr, ralimstr))
-            queryparts.append("acos(")
-            queryparts.append("sin(%f - fielddec)*cos(fieldra)*sin(%f - %f*(%f))*cos(%f*%f) + "%(piover2, piover2, deg2rad, dec, deg2rad, ra))
-            queryparts.append("sin(%f - fielddec)*sin(fieldra)*sin(%f - %f*(%f))*sin(%f*%f) + "%(piover2, piover2, deg2rad, dec, deg2rad, ra))
-            queryparts.append("cos(%f - fielddec)*cos(%f - %f*%f) "%(piover2, piover2, deg2rad, dec))
-            queryparts.append(")< %f) a, %s b where "%(pointing_radius_rad, simtab))
-            queryparts.append("a.fieldra = b.fieldra and a.fielddec = b.fielddec and filter = \'%s\' order by b.expMJD"%(filt))
-            #Query string to do the 3 space dot product of the pointing specified by ra/dec and all dithered field centers.
-            #Selects all field centers within 0.03054/deg2rad = 1.74981 degrees of the ra/dec pair
-        query = "".join(queryparts)
+            queryparts.append("(select %sra, %sdec from %s where %sdec %s and (%sra %s) group by %sra, %sdec) a where "%(p, p, simtab, p, declimstr, p, ralimstr, p, p))
+        queryparts.append("acos(")
+        queryparts.append("sin(%f - %sdec)*cos(%sra)*sin(%f - %f*(%f))*cos(%f*%f) + "%(piover2, p, p, piover2, deg2rad, dec, deg2rad, ra))
+        queryparts.append("sin(%f - %sdec)*sin(%sra)*sin(%f - %f*(%f))*sin(%f*%f) + "%(piover2, p, p, piover2, deg2rad, dec, deg2rad, ra))
+        queryparts.append("cos(%f - %sdec)*cos(%f - %f*%f) "%(piover2, p, piover2, deg2rad, dec))
+        queryparts.append(")< %f) a, %s b where "%(pointing_radius_rad, simtab))
+        queryparts.append("a.%sra = b.%sra and a.%sdec = b.%sdec and %s order by b.expMJD"%(p, p, p, p, filterpred))
         #Join pieces of the query string
-        self.cursor.execute(query)
-        result = self.cursor.fetchall()
-        #Execute query and return all results
-        #Check if query returns.  If not, return empty arrays.
-        if len(result) == 0:
-            time = num.asarray(time)
-            m5 = num.asarray(m5)
-        else:
-            #Read results into arrays.  The star is very important.
-            time, m5 = zip(*result)
-            time = num.asarray(time)
-            m5 = num.asarray(m5)
-        return time, m5
+        return "".join(queryparts)
+
+class DBPool:
+    ''' Bounded pool of DB connections shared between threads.
+        Has the getTimeMagSQL and getTimeMagBatch contract of DB; each call borrows a connection
+        for its duration, so up to size queries run at once.  Connections are opened as needed.
+    '''
+    def __init__(self, size=4, connect=None, centerTables=None):
+        '''
+        Inputs:
+        size -- maximum number of connections
+        connect -- connection factory passed to each DB, see DB.__init__
+        centerTables -- versions using center tables, passed to each DB, see DB.__init__
+        '''
+        self.size = size
+        self._connect = connect
+        self._centerTables = centerTables
+        self._idle = Queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *dumArgs):
+        self.close()
+
+    def __getstate__(self):
+        return {'size': self.size, 'connect': self._connect, 'centerTables': self._centerTables}
+
+    def __setstate__(self, state):
+        self.__init__(state['size'], state['connect'], state.get('centerTables'))
+
+    def acquire(self):
+        '''Borrow a connection, waiting if all size connections are in use'''
+        self._slots.acquire()
+        try:
+            with self._lock:
+                assert not self._closed, "DBPool is closed"
+                try:
+                    return self._idle.get_nowait()
+                except Queue.Empty:
+                    pass
+            db = DB(self._connect, self._centerTables)
+            with self._lock:
+                closed = self._closed
+            if closed:
+                db.close()
+                raise AssertionError("DBPool is closed")
+            return db
+        except:
+            self._slots.release()
+            raise
+
+    def release(self, db):
+        '''Return a borrowed connection to the pool, or close it if the pool has been closed meanwhile'''
+        with self._lock:
+            closed = self._closed
+            if not closed:
+                self._idle.put(db)
+        if closed:
+            db.close()
+        self._slots.release()
+
+    def close(self):
+        '''Close all connections of the pool; may be safely called even if already closed.  Connections
+           borrowed at the time are closed when they are released.
+        '''
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, Queue.LifoQueue()
+        while not idle.empty():
+            idle.get_nowait().close()
+
+    def isOpen(self):
+        return not self._closed
+
+    def getTimeMagSQL(self, ra, dec, filt, doDith=False, version="opsim3_61"):
+        ''' See DB.getTimeMagSQL '''
+        db = self.acquire()
+        try:
+            return db.getTimeMagSQL(ra, dec, filt, doDith, version)
+        finally:
+            self.release(db)
+
+    def getTimeMagBatch(self, ras, decs, filt, doDith=False, version="opsim3_61"):
+        ''' See DB.getTimeMagBatch '''
+        db = self.acquire()
+        try:
+            return db.getTimeMagBatch(ras, decs, filt, doDith, version)
+        finally:
+            self.release(db)
+
+    def getTimeMagFilterSQL(self, ra, dec, filts, doDith=False, version="opsim3_61"):
+        ''' See DB.getTimeMagFilterSQL '''
+        db = self.acquire()
+        try:
+            return db.getTimeMagFilterSQL(ra, dec, filts, doDith, version)
+        finally:
+            self.release(db)
+
+    def getTimeMagFilterBatch(self, ras, decs, filts, doDith=False, version="opsim3_61"):
+        ''' See DB.getTimeMagFilterBatch '''
+        db = self.acquire()
+        try:
+            return db.getTimeMagFilterBatch(ras, decs, filts, doDith, version)
+        finally:
+            self.release(db)
@@ -0,0 +1,79 @@
+''' Spatial index over the distinct field centers of an OpSim run.
+    The centers are held as unit vectors in a KD-tree so the fields covering a position are found
+    with a chord length search instead of evaluating an acos for every field.  RA wraparound and the
+    poles need no special treatment on the unit sphere.
+    query answers "which fields cover (ra, dec)" for a single position, queryArray for a whole
+    array of positions in one call.
+'''
+import math
+import numpy as num
+from scipy.spatial import cKDTree
+
+def toUnitVectors(ras, decs):
+    ''' Convert arrays of ra, dec in radians into an (n, 3) array of unit vectors '''
+    ras = num.asarray(ras, dtype=float)
+    decs = num.asarray(decs, dtype=float)
+    cosdec = num.cos(decs)
+    return num.column_stack((cosdec*num.cos(ras), cosdec*num.sin(ras), num.sin(decs)))
+
+class FieldIndex:
+    ''' Class for finding the field centers within a radius of sky positions '''
+    pointing_radius_deg = 1.75
+    def __init__(self, ras, decs):
+        '''
+        Build the index over field centers.
+        Inputs:
+        ras -- field center RA values in radians, as stored in the OpSim tables
+        decs -- field center declination values in radians, as stored in the OpSim tables
+        '''
+        self.ras = num.asarray(ras, dtype=float)
+        self.decs = num.asarray(decs, dtype=float)
+        self._tree = cKDTree(toUnitVectors(self.ras, self.decs))
+
+    def __len__(self):
+        return len(self.ras)
+
+    def _chord(self, radius):
+        if radius is None:
+            radius = self.pointing_radius_deg
+        return 2.*math.sin(0.5*radius*math.pi/180.)
+
+    def query(self, ra, dec, radius=None):
+        '''
+        Find the fields covering a single position
+        Inputs:
+        ra -- RA in degrees
+        dec -- declination in degrees
+        radius -- search radius in degrees, the field radius of 1.75 degrees if None
+        Return:
+        sorted array of indices of the covering field centers
+        '''
+        vec = toUnitVectors([ra*math.pi/180.], [dec*math.pi/180.])[0]
+        idx = self._tree.query_ball_point(vec, self._chord(radius))
+        return num.sort(num.asarray(idx, dtype=int))
+
+    def queryArray(self, ras, decs, radius=None):
+        '''
+        Find the fields covering each of an array of positions
+        Inputs:
+        ras -- array of RA values in degrees
+        decs -- array of declination values in degrees
+        radius -- search radius in degrees, the field radius of 1.75 degrees if None
+        Return:
+        fields -- indices of the covering field centers for all positions, concatenated
+        offsets -- array of len(ras)+1 offsets; the fields of position i are fields[offsets[i]:offsets[i+1]]
+        '''
+        ras = num.atleast_1d(num.asarray(ras, dtype=float))
+        decs = num.atleast_1d(num.asarray(decs, dtype=float))
+        assert len(ras) == len(decs), "ra and dec arrays must be the same length"
+        npos = len(ras)
+        if npos == 0 or len(self) == 0:
+            return num.zeros(0, dtype=int), num.zeros(npos + 1, dtype=int)
+        postree = cKDTree(toUnitVectors(ras*math.pi/180., decs*math.pi/180.))
+        pairs = postree.sparse_distance_matrix(self._tree, self._chord(radius), output_type='ndarray')
+        order = num.lexsort((pairs['j'], pairs['i']))
+        posidx = pairs['i'][order]
+        fields = pairs['j'][order].astype(int)
+        offsets = num.zeros(npos + 1, dtype=int)
+        offsets[1:] = num.cumsum(num.bincount(posidx, minlength=npos))
+        return fields, offsets
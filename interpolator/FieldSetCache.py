@@ -0,0 +1,191 @@
+''' Cache of cadences keyed by the set of fields covering a position.
+    Within one OpSim run every position covered by the same set of field centers has the same
+    undithered cadence, and a dense grid of positions has far fewer distinct field sets than positions.
+    FieldSetCache wraps a PointingStore and has the same getTimeMagSQL, getTimeMagBatch and
+    getTimeMagFilterBatch contract, so it may be passed to LightCurve.Realize in its place.  Positions
+    are resolved to their field sets with PointingStore.getFieldSets, the cadence of each field set
+    missing from the cache is computed once by PointingStore.getFieldSetCadences, and cadences are kept
+    as read only arrays keyed by (snapshot, field set, filter, version, doDith), the snapshot being
+    PointingStore.getSnapshotId, as field set numbers only have meaning within one import of a run.  At most maxsize cadences are
+    held in memory; with a spill directory the least recently used are written there when evicted and
+    read back when asked for again, so a grid run may keep every field set of a run.
+    Dithered requests are memoized the same way by their sets of dithered centers.
+'''
+from collections import OrderedDict
+import os
+import hashlib
+import tempfile
+import threading
+import numpy as num
+from DB import packCadences, _uniqueFilters
+from PointingStore import _expandSets
+
+class FieldSetCache:
+    ''' Class for caching the cadences of field sets of a PointingStore '''
+    def __init__(self, store, maxsize=100000, spilldir=None):
+        '''
+        Construct a cache in front of store
+        Inputs:
+        store -- PointingStore, or another source with getFieldSets, getFieldSetCadences and getSnapshotId methods
+        maxsize -- maximum number of cadences to hold in memory; the least recently used are evicted first
+        spilldir -- directory to which evicted cadences are written, created if needed; None to drop them
+        '''
+        self.store = store
+        self.maxsize = maxsize
+        self.spilldir = spilldir
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.spills = 0
+        #Guards the cache, not the wrapped store, so Realize's prefetch threads may share it
+        self._lock = threading.RLock()
+        if spilldir is not None and not os.path.isdir(spilldir):
+            try:
+                os.makedirs(spilldir)
+            except OSError:
+                #Created meanwhile by another process
+                if not os.path.isdir(spilldir):
+                    raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *dumArgs):
+        self.close()
+
+    def close(self):
+        '''Close the wrapped store; the cached cadences are kept'''
+        self.store.close()
+
+    def isOpen(self):
+        return self.store.isOpen()
+
+    def __getstate__(self):
+        #The cadences held in memory stay with this process; spilled cadences are shared through the directory
+        return {'store': self.store, 'maxsize': self.maxsize, 'spilldir': self.spilldir}
+
+    def __setstate__(self, state):
+        self.__init__(state['store'], state['maxsize'], state['spilldir'])
+
+    def clear(self):
+        '''Drop all cadences held in memory'''
+        self._cache.clear()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def _key(self, snapshot, fields, filt, version, doDith):
+        return (snapshot, fields.tostring(), filt, version.lower(), bool(doDith))
+
+    def _spillPath(self, key):
+        return os.path.join(self.spilldir, hashlib.sha1(repr(key)).hexdigest() + '.npz')
+
+    def _get(self, key):
+        #Move the entry to the most recently used end, reading it back from the spill directory if
+        #it was evicted there; returns None if not cached
+        with self._lock:
+            value = self._cache.pop(key, None)
+            if value is not None:
+                self._cache[key] = value
+                return value
+        if self.spilldir is None:
+            return None
+        path = self._spillPath(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            npz = num.load(path)
+            try:
+                value = (npz['time'], npz['m5'])
+            finally:
+                npz.close()
+        except (IOError, KeyError, ValueError):
+            #Unreadable spill file; compute the cadence again
+            return None
+        return self._put(key, value[0], value[1])
+
+    def _put(self, key, time, m5):
+        time = num.array(time, dtype=float)
+        m5 = num.array(m5, dtype=float)
+        time.flags.writeable = False
+        m5.flags.writeable = False
+        evicted = []
+        with self._lock:
+            self._cache[key] = (time, m5)
+            while len(self._cache) > self.maxsize:
+                evicted.append(self._cache.popitem(last=False))
+        if self.spilldir is not None:
+            for oldkey, (oldtime, oldm5) in evicted:
+                self._spill(oldkey, oldtime, oldm5)
+        return time, m5
+
+    def _spill(self, key, time, m5):
+        path = self._spillPath(key)
+        if os.path.exists(path):
+            return
+        #Written under a temporary name and renamed so readers never see a partial file
+        fd, tmpname = tempfile.mkstemp(dir=self.spilldir, suffix='.npz')
+        fh = os.fdopen(fd, 'wb')
+        try:
+            num.savez(fh, time=time, m5=m5)
+        finally:
+            fh.close()
+        os.rename(tmpname, path)
+        self.spills += 1
+
+    def _setCadences(self, ras, decs, filts, doDith, version):
+        #Cadences of the field set of each position in each filter, computing those of the field sets
+        #missing from the cache in one call to the store
+        setid, fields, setoff = self.store.getFieldSets(ras, decs, version, doDith)
+        snapshot = self.store.getSnapshotId(version, doDith)
+        nsets = len(setoff) - 1
+        cadences = dict([(f, [None]*nsets) for f in filts])
+        missing = []
+        for k in range(nsets):
+            for f in filts:
+                cadences[f][k] = self._get(self._key(snapshot, fields[setoff[k]:setoff[k+1]], f, version, doDith))
+            if any([cadences[f][k] is None for f in filts]):
+                missing.append(k)
+        self.hits += (nsets - len(missing))*len(filts)
+        self.misses += len(missing)*len(filts)
+        if missing:
+            missing = num.asarray(missing, dtype=int)
+            counts = setoff[missing + 1] - setoff[missing]
+            mfields = num.concatenate([fields[setoff[k]:setoff[k+1]] for k in missing])
+            moff = num.zeros(len(missing) + 1, dtype=int)
+            moff[1:] = num.cumsum(counts)
+            fetched = self.store.getFieldSetCadences(mfields, moff, filts, version, doDith)
+            for f in filts:
+                time, m5, offsets = fetched[f]
+                for j, k in enumerate(missing):
+                    key = self._key(snapshot, fields[setoff[k]:setoff[k+1]], f, version, doDith)
+                    cadences[f][k] = self._put(key, time[offsets[j]:offsets[j+1]], m5[offsets[j]:offsets[j+1]])
+        return setid, cadences
+
+    def getTimeMagSQL(self, ra, dec, filt, doDith=False, version="opsim3_61"):
+        ''' Retrieve timing for a single ra/dec pair, from the cache if possible.  See DB.getTimeMagSQL '''
+        time, m5, offsets = self.getTimeMagBatch([ra], [dec], filt, doDith, version)
+        return time, m5
+
+    def getTimeMagBatch(self, ras, decs, filt, doDith=False, version="opsim3_61"):
+        ''' Retrieve timing for a sequence of ra/dec pairs, computing the cadence of each field set not
+            already cached once.  See DB.getTimeMagBatch
+        '''
+        assert len(ras) == len(decs), "ra and dec arrays must be the same length"
+        setid, cadences = self._setCadences(ras, decs, [filt], doDith, version)
+        time, m5, setoff = packCadences(cadences[filt])
+        return _expandSets(time, m5, setoff, setid)
+
+    def getTimeMagFilterBatch(self, ras, decs, filts, doDith=False, version="opsim3_61"):
+        ''' Retrieve timing for a sequence of ra/dec pairs in several filters.  Field sets missing any of the
+            filters from the cache are computed in all of them with one call to the store.
+            See DB.getTimeMagFilterBatch
+        '''
+        assert len(ras) == len(decs), "ra and dec arrays must be the same length"
+        filts = _uniqueFilters(filts)
+        setid, cadences = self._setCadences(ras, decs, filts, doDith, version)
+        packed = {}
+        for f in filts:
+            time, m5, setoff = packCadences(cadences[f])
+            packed[f] = _expandSets(time, m5, setoff, setid)
+        return packed
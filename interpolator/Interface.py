@@ -1,9 +1,111 @@
 import sys
+import os
 import numpy
 import MySQLdb
 from scipy.interpolate import InterpolatedUnivariateSpline
+from scipy.interpolate import UnivariateSpline
+from scipy.interpolate import BSpline
+from Interpolate import MultiBandSpline, TabulatedSpline
+from TemplateCache import loadTemplate
+from MagUtils import MagUtils, FILTERS
 
-FILTERS = ['u', 'g', 'r', 'i', 'z', 'y']
+#############
+# TEMPLATE CACHE
+#
+# Parsed template files and their splines are shared by every generator in the process.
+# Templates are keyed by (filename, mtime), splines by (filename, mtime, isPerfect),
+# so editing a template file invalidates its entries.  Templates are read from their compiled
+# binary file when it is fresh, see TemplateCache.
+# The splines are fitted to the template magnitudes without any magnitude offset, which is added
+# at evaluation (the spline of y + c is the spline of y plus c), so objects with distinct offsets
+# share one set of splines and the caches hold one entry per template file.
+
+_tableCache     = {}
+_splineCache    = {}
+_multiBandCache = {}
+_tabulatedCache = {}
+
+def _purge(cache, key):
+    # drop entries for older versions of the file
+    for old in [k for k in cache if k[0] == key[0] and k[1] != key[1]]:
+        del cache[old]
+
+class _OffsetSpline:
+    # a shared spline of a template evaluated with a magnitude offset added
+    def __init__(self, spline, magOff):
+        self.spline = spline
+        self.magOff = magOff
+
+    def __call__(self, *args, **kwargs):
+        return self.spline(*args, **kwargs) + self.magOff
+
+    def __getattr__(self, name):
+        return getattr(self.spline, name)
+
+def _withOffset(spline, magOff):
+    if magOff == 0.:
+        return spline
+    return _OffsetSpline(spline, magOff)
+
+def _templateKey(filename):
+    filename = os.path.abspath(filename)
+    return (filename, os.path.getmtime(filename))
+
+def getTemplateObject(filename):
+    # returns the parsed template: columns, header and any compiled spline coefficients
+    key = _templateKey(filename)
+    if key not in _tableCache:
+        _purge(_tableCache, key)
+        _tableCache[key] = loadTemplate(filename)
+    return _tableCache[key]
+
+def getTemplate(filename):
+    # returns the template columns: phase (or time) followed by the u, g, r, i, z, y mags
+    return getTemplateObject(filename).data
+
+def getSplines(filename, magOff = 0., isPerfect = True):
+    # returns a dictionary of splines of the template, one per filter
+    key = _templateKey(filename) + (isPerfect,)
+    if key not in _splineCache:
+        _purge(_splineCache, key)
+        template = getTemplateObject(filename)
+        lc   = template.data
+        xval = lc[0]
+        splines = {}
+        for i, f in enumerate(FILTERS):
+            if isPerfect and template.tck is not None:
+                # rebuilt from the compiled coefficients without fitting
+                t, c, k = template.tck
+                splines[f] = BSpline(t, c[:,i], k)
+            elif isPerfect:
+                # InterpolatedUnivariateSpline explicitly goes through each data point
+                splines[f] = InterpolatedUnivariateSpline(xval, lc[i+1])
+            else:
+                # UnivariateSpline smooths
+                splines[f] = UnivariateSpline(xval, lc[i+1])
+        _splineCache[key] = splines
+    return dict([(f, _withOffset(spline, magOff)) for f, spline in _splineCache[key].items()])
+
+def getMultiBandSpline(filename, magOff = 0., isPerfect = True):
+    # returns a MultiBandSpline of the template evaluating all of FILTERS in one call
+    key = _templateKey(filename) + (isPerfect,)
+    if key not in _multiBandCache:
+        _purge(_multiBandCache, key)
+        if isPerfect:
+            _multiBandCache[key] = getTemplateObject(filename).getMultiBandSpline()
+        else:
+            lc = getTemplate(filename)
+            _multiBandCache[key] = MultiBandSpline(lc[0], lc[1:len(FILTERS)+1].T, isIdeal = isPerfect)
+    return _withOffset(_multiBandCache[key], magOff)
+
+def getTabulatedSpline(filename, magOff = 0., isPerfect = True, tolerance = 1e-3, kind = 'linear'):
+    # returns a TabulatedSpline of all of FILTERS of a periodic template, within tolerance mags of the splines
+    key = _templateKey(filename) + (isPerfect, tolerance, kind)
+    if key not in _tabulatedCache:
+        _purge(_tabulatedCache, key)
+        spline = getMultiBandSpline(filename, 0., isPerfect)
+        _tabulatedCache[key] = TabulatedSpline(spline, tolerance, kind)
+    return _withOffset(_tabulatedCache[key], magOff)
 
 #############
 # BASE CLASS
@@ -21,6 +123,10 @@ class variabilityGenerator:
     def getParams(self):
         # must be overridden for every derived class
         pass
+
+    def getWindow(self):
+        # interval of epochs outside of which the source has no flux, None if it has flux at all epochs
+        return None
         
     def evaluate(self, epochs):
         # must be overridden for every derived class
@@ -33,12 +139,18 @@ class variabilityGenerator:
 # FOR INTERFACE WITH A TEXT FILE THAT WILL BE USED TO SPLINE-INTERPOLATE A LIGHTCURVE
 
 class interpolateGenerator(variabilityGenerator):
-    def __init__(self, infile, mag0 = 0., t0 = 0.):
+    def __init__(self, infile, mag0 = 0., t0 = 0., tolerance = None, tabulation = 'linear'):
+        # tolerance: if given, periodic templates are evaluated from a table over phase deviating
+        #            at most this many mags from the splines (see TabulatedSpline); the deviation
+        #            reached is reported in params['maxDeviation'] after the first evaluation
+        # tabulation: 'linear' or 'cubic' interpolation in the table
         variabilityGenerator.__init__(self)
         self.filename = infile
         self.params   = {}
         self._t0      = t0
         self._m0      = mag0
+        self._tol     = tolerance
+        self._tabkind = tabulation
 
     def getParams(self):
         # Required header format:
@@ -52,62 +164,93 @@ class interpolateGenerator(variabilityGenerator):
         # XXX.X XXX.X  ...
         
         self.params['filename'] = self.filename
-        fh = open(self.filename)
-        period = fh.readline().split()[3]
-        self.params['isPeriodic'] = fh.readline().split()[3]
-        fh.close() 
-        if self.params['isPeriodic']:
-            self.params['period'] = float(period)
+        # header lines are matched by key; any IsPeriodic value but True is taken as non-periodic,
+        # and the Period line then gives the lifetime.  Without an IsPeriodic line a template with
+        # a Period line is periodic
+        header = getTemplateObject(self.filename).params
+        self.params['isPeriodic'] = header.get('isPeriodic', header.has_key('period'))
+        if header.has_key('period'):
+            self.params['period'] = header['period']
+        elif header.has_key('lifetime'):
+            self.params['lifetime'] = header['lifetime']
         else:
-            self.params['lifetime'] = float(period)
+            raise Exception("No period or lifetime in the header of %s"%(self.filename))
         self.params['tOff']     = self._t0
         self.params['magOff']   = self._m0
 
         
-    def evaluate(self, epochs, filt = None, isPerfect = True):
-        lc    = numpy.loadtxt(self.params['filename'], unpack = True, comments='#')
-        xval  = lc[0]
-        uLc   = lc[1]+self.params['magOff']
-        gLc   = lc[2]+self.params['magOff']
-        rLc   = lc[3]+self.params['magOff']
-        iLc   = lc[4]+self.params['magOff']
-        zLc   = lc[5]+self.params['magOff']
-        yLc   = lc[6]+self.params['magOff']
-
-        splines = {}
-        if isPerfect:
-            # InterpolatedUnivariateSpline explicitly goes through each data point
-            splines['u'] = InterpolatedUnivariateSpline(xval, uLc)
-            splines['g'] = InterpolatedUnivariateSpline(xval, gLc)
-            splines['r'] = InterpolatedUnivariateSpline(xval, rLc)
-            splines['i'] = InterpolatedUnivariateSpline(xval, iLc)
-            splines['z'] = InterpolatedUnivariateSpline(xval, zLc)
-            splines['y'] = InterpolatedUnivariateSpline(xval, yLc)
-        else:
-            # UnivariateSpline smooths
-            splines['u'] = UnivariateSpline(xval, uLc)
-            splines['g'] = UnivariateSpline(xval, gLc)
-            splines['r'] = UnivariateSpline(xval, rLc)
-            splines['i'] = UnivariateSpline(xval, iLc)
-            splines['z'] = UnivariateSpline(xval, zLc)
-            splines['y'] = UnivariateSpline(xval, yLc)
-            
-        epochs -= self.params['tOff']
+    def getPhase(self, epochs):
+        # do not shift the caller's epochs in place; they may be shared with other models
+        epochs = numpy.asarray(epochs) - self.params['tOff']
         
         if self.params.has_key('lifetime'):  
-            spleval = epochs
+            return epochs
         elif self.params.has_key('period'):
-            spleval = epochs / self.params['period'] - epochs // self.params['period']
+            return epochs / self.params['period'] - epochs // self.params['period']
         else:
             raise Exception("No lifetime or period specified for this light curve")
 
+    def getWindow(self):
+        # interval of epochs covered by a non-periodic template, outside of which it has no flux;
+        # None for periodic templates
+        if not self.params.has_key('lifetime'):
+            return None
+        xval = getTemplate(self.params['filename'])[0]
+        return (self.params['tOff'] + xval[0], self.params['tOff'] + xval[-1])
+
+    def getNoFluxMag(self, filt):
+        # magnitude of zero flux, returned outside the window of a non-periodic template
+        return MagUtils().toMag(0., filt)
+
+    def getTabulated(self, isPerfect = True):
+        # the TabulatedSpline used for evaluation, or None when evaluating the splines directly
+        if self._tol is None or not self.params.has_key('period'):
+            return None
+        table = getTabulatedSpline(self.params['filename'], self.params['magOff'], isPerfect, self._tol, self._tabkind)
+        self.params['maxDeviation'] = table.maxerr
+        return table
+
+    def evaluateBands(self, epochs, isPerfect = True):
+        # all of FILTERS in one spline evaluation; returns an array of shape epochs.shape + (len(FILTERS),)
+        spline = self.getTabulated(isPerfect)
+        if spline is None:
+            spline = getMultiBandSpline(self.params['filename'], self.params['magOff'], isPerfect)
+        return spline(self.getPhase(epochs))
+
+    def evaluate(self, epochs, filt = None, isPerfect = True):
+        window = self.getWindow()
+        if window is not None:
+            # splines are evaluated only at the epochs inside the template
+            epochs = numpy.asarray(epochs, dtype = float)
+            inside = (epochs >= window[0]) & (epochs <= window[1])
+            if filt == None:
+                mags = self.evaluateBands(epochs[inside], isPerfect)
+                for i, f in enumerate(FILTERS):
+                    self.dMag[f] = numpy.empty(epochs.shape)
+                    self.dMag[f].fill(self.getNoFluxMag(f))
+                    self.dMag[f][inside] = mags[..., i]
+                return self.dMag
+            assert(filt in FILTERS)
+            splines = getSplines(self.params['filename'], self.params['magOff'], isPerfect)
+            self.dMag[filt] = numpy.empty(epochs.shape)
+            self.dMag[filt].fill(self.getNoFluxMag(filt))
+            self.dMag[filt][inside] = splines[filt](self.getPhase(epochs[inside]))
+            return self.dMag[filt]
+        table = self.getTabulated(isPerfect)
+        if filt != None and table is not None:
+            assert(filt in FILTERS)
+            self.dMag[filt] = table(self.getPhase(epochs), band = FILTERS.index(filt))
+            return self.dMag[filt]
         if filt == None:
-            for f in FILTERS:
-                self.dMag[f] = splines[f](spleval)
+            mags = self.evaluateBands(epochs, isPerfect)
+            for i, f in enumerate(FILTERS):
+                self.dMag[f] = mags[..., i]
             return self.dMag
         else:
             assert(filt in FILTERS)
-            self.dMag[filt] = splines[filt](spleval)
+            # the template is parsed and splined once per process; see getSplines
+            splines = getSplines(self.params['filename'], self.params['magOff'], isPerfect)
+            self.dMag[filt] = splines[filt](self.getPhase(epochs))
             return self.dMag[filt]
 
             
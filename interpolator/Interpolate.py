@@ -4,17 +4,32 @@
     evalper evaluates the input spline assuming a periodic input curve
     evalnonper evaluates the input spline assuming a non-periodic input curve
     splineinterp calls the appropriate evalutaion algorithm based on the boolean value isperiodic
+    MultiBandSpline holds the splines of several bands sampled at the same points as one spline with
+    shared knots so all bands are evaluated in a single call
+    SplineTck holds a spline as its knots, coefficients and degree (t, c, k), the compact form in which
+    splines are cached on disk by SplineCache and pickled to worker processes
+    TabulatedSpline samples a spline on a dense grid over phase [0, 1] chosen from a tolerance so it
+    may be evaluated by table lookup in place of the spline
     Modified:
     Jan 2008 by K. Simon Krughoff krughoff@astro.washington.edu
 '''
+import os
+import hashlib
+import tempfile
+import threading
 import warnings
 import exceptions
+from collections import OrderedDict
 warnings.simplefilter('ignore', category=exceptions.DeprecationWarning)
 from scipy.interpolate import UnivariateSpline
 from scipy.interpolate import InterpolatedUnivariateSpline
+from scipy.interpolate import splrep, splev, BSpline
 import numpy as num
 
-def makespline(x, y, sfactor=None, isIdeal=True):
+#Cache used by makespline when none is passed, see setSplineCache
+_splineCache = None
+
+def makespline(x, y, sfactor=None, isIdeal=True, cache=None):
     ''' Make a spline interpolation of the input curve defined by x and y.
         Calculate smoothing factor, s, based on the dynamic range of the 
         dependent variable, y.
@@ -22,9 +37,25 @@ def makespline(x, y, sfactor=None, isIdeal=True):
         x -- independent variable for curve
         y -- dependent variable for curve
         sfactor -- smoothing factor.  If None sfactor is calculated from the data
+        isIdeal -- True for an interpolating spline through each point, False for a smoothing spline
+        cache -- SplineCache looked up before fitting and filled after; the cache set by
+                 setSplineCache if None.  With a cache the spline is returned as a SplineTck.
         Return:
         spline of input lightcurve
     '''
+    if cache is None:
+        cache = _splineCache
+    if cache is not None:
+        key = cache.getKey(x, y, sfactor, isIdeal)
+        spline = cache.get(key)
+        if spline is None:
+            spline = SplineTck(*splineToTck(_fitspline(x, y, sfactor, isIdeal)))
+            cache.put(key, spline)
+        return spline
+    return _fitspline(x, y, sfactor, isIdeal)
+
+def _fitspline(x, y, sfactor, isIdeal):
+    #Fit the spline of makespline
     val = None
     min = num.fabs(y).min()
     max = num.fabs(y).max()
@@ -48,6 +79,162 @@ def makespline(x, y, sfactor=None, isIdeal=True):
         tck = UnivariateSpline(x, y, s=s)
     return tck
 
+def splineToTck(spline):
+    ''' Return the (knots, coefficients, degree) of a scipy UnivariateSpline, a BSpline or a SplineTck '''
+    if isinstance(spline, BSpline):
+        return spline.t, spline.c, spline.k
+    if isinstance(spline, SplineTck):
+        return spline.getTck()
+    t, c, k = spline._eval_args
+    return t, c, k
+
+def setSplineCache(cache):
+    '''
+    Set the cache used by makespline, and so by TimeSeriesMag, when none is passed
+    Inputs:
+    cache -- SplineCache, a directory for a SplineCache, or None for no cache
+    Return:
+    the previous cache
+    '''
+    global _splineCache
+    if isinstance(cache, basestring):
+        cache = SplineCache(cache)
+    previous = _splineCache
+    _splineCache = cache
+    return previous
+
+def getSplineCache():
+    return _splineCache
+
+class SplineTck:
+    ''' Spline held as knots t, coefficients c and degree k.
+        Evaluation goes through scipy's splev as a UnivariateSpline does, extrapolating outside the knots,
+        so a spline rebuilt from the (t, c, k) of a scipy spline gives identical values.  Only the three
+        arrays are pickled.
+    '''
+    def __init__(self, t, c, k):
+        self.t = num.asarray(t, dtype=float)
+        self.c = num.asarray(c, dtype=float)
+        self.k = int(k)
+
+    def getTck(self):
+        return self.t, self.c, self.k
+
+    def __call__(self, x):
+        x = num.asarray(x)
+        if x.size == 0:
+            return num.array([])
+        return splev(x, (self.t, self.c, self.k))
+
+class SplineCache:
+    ''' Content addressed cache of fitted splines.
+        A spline is keyed by the SHA-1 of the x and y arrays and the fit parameters, so identical inputs
+        are never refit.  Splines are held in memory and, if a directory is given, written to
+        <directory>/<key[:2]>/<key>.npz so other processes and later runs share them.
+    '''
+    #Bump when the fit or the file layout changes so that older entries are ignored
+    version = 1
+    def __init__(self, directory=None, maxsize=10000):
+        '''
+        Inputs:
+        directory -- directory of the on disk cache, created if needed; memory only if None
+        maxsize -- maximum number of splines held in memory; the least recently used are evicted first
+        '''
+        self.directory = directory
+        self.maxsize = maxsize
+        self._splines = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if directory is not None and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                #Created meanwhile by another process
+                if not os.path.isdir(directory):
+                    raise
+
+    def __getstate__(self):
+        #Splines held in memory stay with this process
+        return {'directory': self.directory, 'maxsize': self.maxsize}
+
+    def __setstate__(self, state):
+        self.__init__(state['directory'], state['maxsize'])
+
+    def __len__(self):
+        return len(self._splines)
+
+    def getKey(self, x, y, sfactor=None, isIdeal=True):
+        ''' Return the hexadecimal key of the spline fit to x and y with parameters sfactor and isIdeal '''
+        digest = hashlib.sha1(repr((self.version, sfactor, bool(isIdeal))))
+        for a in (x, y):
+            a = num.ascontiguousarray(a, dtype=float)
+            digest.update(repr(a.shape))
+            digest.update(a.tostring())
+        return digest.hexdigest()
+
+    def getPath(self, key):
+        return os.path.join(self.directory, key[:2], key + '.npz')
+
+    def get(self, key):
+        ''' Return the SplineTck cached under key, None if not cached '''
+        with self._lock:
+            #Move the entry to the most recently used end
+            spline = self._splines.pop(key, None)
+            if spline is not None:
+                self._splines[key] = spline
+                self.hits += 1
+                return spline
+        if self.directory is not None:
+            path = self.getPath(key)
+            if os.path.exists(path):
+                try:
+                    npz = num.load(path)
+                    try:
+                        spline = SplineTck(npz['t'], npz['c'], int(npz['k']))
+                    finally:
+                        npz.close()
+                except (IOError, KeyError, ValueError):
+                    #Unreadable entry; refit
+                    spline = None
+                if spline is not None:
+                    self._remember(key, spline)
+        with self._lock:
+            if spline is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return spline
+
+    def put(self, key, spline):
+        ''' Cache spline, a SplineTck, under key '''
+        self._remember(key, spline)
+        if self.directory is None:
+            return
+        path = self.getPath(key)
+        subdir = os.path.dirname(path)
+        if not os.path.isdir(subdir):
+            try:
+                os.makedirs(subdir)
+            except OSError:
+                if not os.path.isdir(subdir):
+                    raise
+        #Written under a temporary name and renamed so readers never see a partial file
+        fd, tmpname = tempfile.mkstemp(dir=subdir, suffix='.npz')
+        fh = os.fdopen(fd, 'wb')
+        try:
+            num.savez(fh, t=spline.t, c=spline.c, k=spline.k)
+        finally:
+            fh.close()
+        os.rename(tmpname, path)
+
+    def _remember(self, key, spline):
+        with self._lock:
+            self._splines.pop(key, None)
+            self._splines[key] = spline
+            while len(self._splines) > self.maxsize:
+                self._splines.popitem(last=False)
+
 def evalper(tck, xinterpolate, x0, xp):
     ''' Evaluate a periodic spline based on spline tck, and an array of independent values xinterpolate.
         Start may be shifted by offset x0.
@@ -87,12 +274,13 @@ def evalnonper(tck, xspline, xinterpolate, x0, noflux=0.0):
         list of interpolated flux values
     '''
     #Apply offset to input independent values
-    xinterpolate = xinterpolate - x0
-    #Evaluate spilne at each x location in xinterpolate
-    ynew = tck(xinterpolate)
+    xinterpolate = num.asarray(xinterpolate, dtype=float) - x0
     #Return noflux value if x value is not in range of original spline range
-    ynew = num.where(xinterpolate < xspline[0], noflux, ynew)
-    ynew = num.where(xinterpolate > xspline[-1], noflux, ynew)
+    ynew = num.empty(xinterpolate.shape)
+    ynew.fill(noflux)
+    inside = (xinterpolate >= xspline[0]) & (xinterpolate <= xspline[-1])
+    #Evaluate spline only at the x locations in range
+    ynew[inside] = tck(xinterpolate[inside])
     return ynew
 
 def splineinterp(tck, xspline, xvals, x0, isperiodic, xp=-1):
@@ -117,3 +305,133 @@ def splineinterp(tck, xspline, xvals, x0, isperiodic, xp=-1):
     else:
         #execte evalnonper if curve is not periodic
         return evalnonper(tck, xspline, xvals, x0, 0)
+
+class MultiBandSpline:
+    ''' Splines of several bands sampled at the same points, evaluated together.
+        Interpolating splines through the same x values share their knots, so the bands are held as one
+        spline with an (n_coefficients, n_bands) coefficient array and evaluating it returns an
+        (n_points, n_bands) array with a single knot search.  Smoothing splines choose their knots per
+        band and are kept as separate splines.
+    '''
+    def __init__(self, x=None, ys=None, isIdeal=True, sfactor=None, tck=None):
+        '''
+        Inputs:
+        x -- independent variable shared by all bands
+        ys -- (len(x), n_bands) array of the dependent variable of each band
+        isIdeal -- True for interpolating splines through each point, False for smoothing splines
+        sfactor -- smoothing factor for the smoothing splines, the scipy default if None
+        tck -- (knots, (n_coefficients, n_bands) coefficients, degree) of the interpolating splines, as
+               returned by getTck, in place of x and ys
+        '''
+        if tck is not None:
+            t, c, k = tck
+            c = num.asarray(c, dtype=float)
+            self.nbands = c.shape[1]
+            self._spline = BSpline(num.asarray(t, dtype=float), c, int(k))
+            self._splines = None
+            return
+        x = num.asarray(x, dtype=float)
+        ys = num.asarray(ys, dtype=float)
+        self.nbands = ys.shape[1]
+        if isIdeal:
+            tcks = [splrep(x, ys[:,i], s=0) for i in range(self.nbands)]
+            t, c, k = tcks[0]
+            ncoeff = len(t) - k - 1
+            coeffs = num.column_stack([tck[1][:ncoeff] for tck in tcks])
+            self._spline = BSpline(t, coeffs, k)
+            self._splines = None
+        else:
+            self._spline = None
+            self._splines = [UnivariateSpline(x, ys[:,i], s=sfactor) for i in range(self.nbands)]
+
+    @classmethod
+    def fromTck(cls, t, c, k):
+        ''' Rebuild interpolating splines from their knots t, (n_coefficients, n_bands) coefficients c and degree k '''
+        return cls(tck=(t, c, k))
+
+    def getTck(self):
+        ''' Return (knots, coefficients, degree) of interpolating splines, None for smoothing splines '''
+        if self._spline is None:
+            return None
+        return self._spline.t, self._spline.c, self._spline.k
+
+    def __call__(self, x):
+        ''' Evaluate all bands at x; returns an array of shape x.shape + (n_bands,) '''
+        if self._spline is not None:
+            return self._spline(x)
+        return num.stack([spline(x) for spline in self._splines], axis=-1)
+
+class TabulatedSpline:
+    ''' Fast approximation of a spline over phase [0, 1] by table lookup.
+        The spline is sampled on a uniform grid whose number of intervals is doubled until the largest
+        deviation from the spline, measured at 16 points through every interval, is within the tolerance.
+        The deviation reached is kept in maxerr.  Evaluation is a vectorized table lookup with linear or
+        cubic (Catmull-Rom) interpolation between grid points.  Input outside [0, 1] is wrapped into it;
+        evalper only passes phases within [0, 1).
+    '''
+    ncheck = 16
+    def __init__(self, spline, tol, kind='linear', metric=None, nmin=64, nmax=2**16):
+        '''
+        Inputs:
+        spline -- callable spline over phase [0, 1], e.g. a scipy spline or a MultiBandSpline
+        tol -- maximum allowed deviation from the spline, in the units given by metric
+        kind -- 'linear' or 'cubic' interpolation between grid points
+        metric -- function mapping spline values onto the units of tol, e.g. flux to magnitudes.
+                  If None the deviation is measured on the spline values directly.
+        nmin -- smallest number of grid intervals to try
+        nmax -- largest number of grid intervals to try; a warning is issued if tol is not reached
+        '''
+        assert kind in ('linear', 'cubic'), "kind must be linear or cubic"
+        self.kind = kind
+        self.tol = tol
+        if metric is None:
+            metric = lambda y: y
+        fracs = (num.arange(self.ncheck) + 0.5)/self.ncheck
+        n = nmin
+        while True:
+            self.n = n
+            #Grid with one extra node at each end for the cubic stencil
+            self._table = num.asarray(spline(num.arange(-1, n + 2)/float(n)))
+            #Differences between neighbouring nodes for linear interpolation
+            self._slope = num.diff(self._table, axis=0)
+            xcheck = (num.arange(n)[:,None] + fracs[None,:]).ravel()/n
+            self.maxerr = num.abs(metric(self(xcheck)) - metric(spline(xcheck))).max()
+            if self.maxerr <= tol or n >= nmax:
+                break
+            n *= 2
+        if self.maxerr > tol:
+            warnings.warn("TabulatedSpline reached %d intervals with deviation %g above tolerance %g"%(n, self.maxerr, tol))
+
+    def __call__(self, x, band=None):
+        '''
+        Evaluate the table at phases x
+        Inputs:
+        x -- phases; values outside [0, 1] are wrapped
+        band -- for a multi band spline, index of the single band to evaluate; all bands if None
+        Return:
+        interpolated values, shape x.shape, or x.shape + (n_bands,) for all bands of a multi band spline
+        '''
+        table = self._table
+        slope = self._slope
+        if band is not None:
+            table = table[:,band]
+            slope = slope[:,band]
+        x = num.asarray(x, dtype=float)
+        if x.size and (x.min() < 0 or x.max() > 1):
+            x = x%1.
+        pos = x*self.n
+        #Interval index, clipped so that x == 1 falls in the last interval.
+        #Grid point idx is held at idx + 1 in the table.
+        idx = pos.astype(num.intp)
+        num.minimum(idx, self.n - 1, out=idx)
+        frac = pos - idx
+        idx += 1
+        if table.ndim > 1:
+            frac = frac[..., None]
+        y1 = table.take(idx, axis=0)
+        if self.kind == 'linear':
+            return y1 + frac*slope.take(idx, axis=0)
+        y0 = table.take(idx - 1, axis=0)
+        y2 = table.take(idx + 1, axis=0)
+        y3 = table.take(idx + 2, axis=0)
+        return y1 + 0.5*frac*((y2 - y0) + frac*((2.*y0 - 5.*y1 + 4.*y2 - y3) + frac*(3.*(y1 - y2) + y3 - y0)))
@@ -3,15 +3,46 @@
     whether the TimeSeries objects are periodic.
     Realize takes a list of ra positions ra, dec positions dec, whether to add
     random errors doAddErr, whether to use the dithered pointings from the database doDith
+    iterRealize yields the same realizations one position (or one block of positions) at a time
+    RealizeTable returns the realizations as one columnar RealizationTable
+    With a seed the noise of each (position, model) pair comes from its own stream, see NoiseStreams, so
+    the realizations are reproducible whatever the workers, blocks or threads.
     Modified:
     March 2008 by K. Simon Krughoff krughoff@astro.washington.edu
     March 2011 by K. Simon Krughoff for TVS group
 '''
 from Interpolate import splineinterp
 from TimeSeriesMag import TimeSeriesMag
-from MagUtils import MagUtils
-from DB import DB
+from MagUtils import MagUtils, filterIndex
+from DB import DB, DBPool
+from RealizationTable import RealizationTable
+from NoiseStreams import normalPairs
 import numpy as num
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from collections import deque, OrderedDict
+import pickle
+
+#Source of time sampling and LightCurve of a worker process of a parallel Realize
+_workerDB = None
+_workerLightCurve = None
+
+def _initWorker(dbstate, lightcurve):
+    ''' Give a worker process its own source of time sampling, the LightCurve to realize and its own random state '''
+    global _workerDB, _workerLightCurve
+    _workerLightCurve = lightcurve
+    if dbstate is None:
+        _workerDB = DB()
+    else:
+        #Unpickling opens a separate handle; see DB.__setstate__ and PointingStore.__setstate__
+        _workerDB = pickle.loads(dbstate)
+    #Forked workers would otherwise draw identical noise when no seed is given
+    num.random.seed()
+
+def _realizeShard(args):
+    ''' Realize one contiguous shard of the positions in a worker process '''
+    ras, decs, kwargs = args
+    return _workerLightCurve.realizeBlock(_workerDB, ras, decs, **kwargs)
 
 class LightCurve:
     #Constants to use in error calculation
@@ -27,7 +58,29 @@ class LightCurve:
         self.tss = ts
         self.isperiodic = isperiodic
 
-    def Realize(self, ras, decs, filtstr=None, doAddErr = False, doDith = False, version="opsim3_61"):
+    def getFilter(self, ts, filtstr=None):
+        '''
+        Return the filter to realize a TimeSeries in
+        Inputs:
+        ts -- TimeSeriesMag object or generator from this LightCurve
+        filtstr -- filter requested of Realize; required for generators, which carry all filters
+        Return:
+        lower case filter string, r if the filter is not known
+        '''
+        if isinstance(ts, TimeSeriesMag):
+            fs = ts.getFilter().lower()
+            if filtstr != None:
+                assert filtstr == fs, "Filter specified in constructor does not match that from the TimeSeries object"
+        else:
+            fs = filtstr
+        if fs not in self.gamma:
+            #We only know sloan filters, so if something different assume r
+            print "Don't know parameters for filter",fs,"\n Assuming r..."
+            fs = 'r'
+        return fs
+
+    def Realize(self, ras, decs, filtstr=None, doAddErr = False, doDith = False, version="opsim3_61", db = None, workers = 1,
+                threads = 0, blocksize = 1000, seed = None):
         ''' 
         Realize the time sampling of a set of pointings based on a database of survey pointings 
         Inputs:
@@ -38,85 +91,431 @@ class LightCurve:
         doDith -- select sampling from the dithered version of the OpSim pointings
         version -- select the version of the Operations Simulator to use.  
                    Currently there are four options: Cronos92 (old), OpSim5_72, OpSim1_29, OpSim3_61 (default)
+        db -- source of the time sampling with a getTimeMagBatch method, e.g. a PointingStore, a DBPool, or
+              a CadenceCache to reuse cadences across calls.
+              If None, a connection to the default database is opened and closed on return, or a DBPool
+              of threads connections if threads > 0.
+        workers -- number of processes to shard the positions over.  Each worker opens its own
+                   handle on db (or its own default database connection if db is None).
+        threads -- number of background threads fetching the cadences of upcoming blocks of positions
+                   while the current block is evaluated.  0 fetches each block in turn.
+        blocksize -- number of positions whose cadences are fetched together
+        seed -- if None the errors are drawn from numpy's global random state.  Otherwise a non negative
+                integer: position i and model j draw their errors from the stream of (seed, i, j), so a
+                given seed gives the same realizations whatever workers, threads and blocksize.
         Return:
         LightCurve object containing TimeSeries resampled based on the chosen operation simulator run
         '''
+        return list(self.iterRealize(ras, decs, filtstr, doAddErr, doDith, version, db, workers, threads, blocksize, seed = seed))
+
+    def RealizeTable(self, ras, decs, filtstr=None, doAddErr = False, doDith = False, version="opsim3_61", db = None, workers = 1,
+                     threads = 0, blocksize = 1000, seed = None):
+        '''
+        Realize as Realize does, returning the realizations as one RealizationTable rather than a list of
+        LightCurve objects.  No TimeSeriesMag objects are made along the way.
+        Inputs:
+        as for Realize
+        Return:
+        RealizationTable of all positions and models
+        '''
+        tables = list(self.iterRealize(ras, decs, filtstr, doAddErr, doDith, version, db, workers, threads, blocksize,
+                                       columnar = True, seed = seed))
+        if len(tables) == 0:
+            filts = [self.getFilter(ts, filtstr) for ts in self.tss]
+            return RealizationTable([], [], filts, [0], [], [], [], [], [])
+        return RealizationTable.concatenate(tables)
+
+    def iterRealize(self, ras, decs, filtstr=None, doAddErr = False, doDith = False, version="opsim3_61", db = None, workers = 1,
+                    threads = 0, blocksize = 1000, chunks = False, columnar = False, seed = None, start = 0):
+        '''
+        Generator version of Realize for position lists too large to hold the realizations of in memory.
+        Positions are realized blocksize at a time and only a bounded number of blocks (threads ahead
+        of the current one, or two per worker) are held at once.
+        Inputs:
+        ras, decs, filtstr, doAddErr, doDith, version, db, workers, threads, blocksize, seed -- as for Realize
+        chunks -- False to yield one LightCurve per position, True to yield a list of the LightCurve
+                  objects of each block of blocksize positions
+        columnar -- True to yield one RealizationTable per block of blocksize positions
+        start -- index of the first position among all positions of a run realized over several calls, so
+                 that each position draws from the noise stream of its index in the run, see Realize
+        Return:
+        generator of LightCurve objects (or lists of them, or RealizationTables) in the order of the input positions
+        '''
         #numpy array of ra positions
         ras = num.asarray(ras)
         #numpy array of dec positions
         decs = num.asarray(decs)
         assert len(ras) == len(decs), "ra and dec arrays must be the same length"
-        db = DB()
+        bounds = range(0, len(ras), blocksize) + [len(ras)]
+        blocks = zip(bounds[:-1], bounds[1:])
+        if workers > 1:
+            results = self._iterParallel(ras, decs, blocks, workers, db, start, filtstr=filtstr, doAddErr=doAddErr, doDith=doDith,
+                                         version=version, columnar=columnar, seed=seed)
+        else:
+            results = self._iterBlocks(ras, decs, blocks, filtstr, doAddErr, doDith, version, db, threads, columnar, seed, start)
+        for lc in results:
+            if chunks or columnar:
+                yield lc
+            else:
+                for l in lc:
+                    yield l
+
+    def _iterBlocks(self, ras, decs, blocks, filtstr, doAddErr, doDith, version, db, threads, columnar, seed = None, start = 0):
+        ''' Realize blocks of positions in this process, yielding the realizations of each block '''
+        ownsdb = db is None
+        if ownsdb:
+            if threads > 0:
+                db = DBPool(threads)
+            else:
+                db = DB()
+        filts = [self.getFilter(ts, filtstr) for ts in self.tss]
+        if columnar:
+            realize = self.realizeTable
+        else:
+            realize = self.realizeCadences
+        def fetch(block):
+            lo, hi = block
+            return self.fetchCadences(db, ras[lo:hi], decs[lo:hi], filts, doDith, version)
+        pool = None
+        try:
+            if threads > 0:
+                #Keep up to threads blocks in flight ahead of the one being evaluated
+                pool = ThreadPool(threads)
+                pending = deque()
+                for block in blocks[:threads]:
+                    pending.append(pool.apply_async(fetch, (block,)))
+                for n, (lo, hi) in enumerate(blocks):
+                    cadences = pending.popleft().get()
+                    if n + threads < len(blocks):
+                        pending.append(pool.apply_async(fetch, (blocks[n + threads],)))
+                    yield realize(ras[lo:hi], decs[lo:hi], filts, cadences, doAddErr, seed, start + lo)
+            else:
+                for lo, hi in blocks:
+                    yield realize(ras[lo:hi], decs[lo:hi], filts, fetch((lo, hi)), doAddErr, seed, start + lo)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            if ownsdb:
+                db.close()
+
+    def realizeBlock(self, db, ras, decs, filtstr=None, doAddErr = False, doDith = False, version="opsim3_61", columnar = False,
+                     seed = None, start = 0):
+        '''
+        Fetch the cadences of a block of positions from db and realize them
+        Inputs:
+        db -- source of the time sampling with a getTimeMagBatch method
+        ras, decs, filtstr, doAddErr, doDith, version, seed -- as for Realize
+        columnar -- True to return a RealizationTable rather than a list of LightCurve objects
+        start -- index of the first position of the block among all positions realized, see drawNoise
+        '''
+        filts = [self.getFilter(ts, filtstr) for ts in self.tss]
+        cadences = self.fetchCadences(db, ras, decs, filts, doDith, version)
+        if columnar:
+            return self.realizeTable(ras, decs, filts, cadences, doAddErr, seed, start)
+        return self.realizeCadences(ras, decs, filts, cadences, doAddErr, seed, start)
+
+    def fetchCadences(self, db, ras, decs, filts, doDith = False, version = "opsim3_61"):
+        '''
+        Get time sampling and 5 sigma limiting magnitude information for a set of positions from the database,
+        once per filter.  Models in the same filter share the same time and m5 arrays.  When the models span
+        several filters and db has a getTimeMagFilterBatch method, all filters are fetched together.
+        Inputs:
+        db -- source of the time sampling with a getTimeMagBatch method
+        ras -- array of RA values in degrees
+        decs -- array of Declination values in degrees
+        filts -- filter of each TimeSeries, see getFilter
+        doDith, version -- as for Realize
+        Return:
+        dictionary of (time, m5, offsets) cadences of the positions keyed by filter, see DB.getTimeMagBatch
+        '''
+        unique = sorted(set(filts))
+        if len(unique) > 1 and hasattr(db, 'getTimeMagFilterBatch'):
+            return db.getTimeMagFilterBatch(ras, decs, unique, doDith, version)
+        cadences = {}
+        for fs in unique:
+            cadences[fs] = db.getTimeMagBatch(ras, decs, fs, doDith, version)
+        return cadences
+
+    def drawNoise(self, seed, start, filts, cadences):
+        '''
+        Draw the noise of every TimeSeries at every epoch of a block of positions from their streams
+        Inputs:
+        seed -- seed of the run, see Realize
+        start -- index of the first position of the block among all positions realized
+        filts -- filter of each TimeSeries, see getFilter
+        cadences -- cadences of the block keyed by filter, see fetchCadences
+        Return:
+        list with, for each TimeSeries, a (2, nepochs) array of unit normal deviates aligned with the
+        epochs time[offsets[0]:offsets[-1]] of the cadence of its filter
+        '''
+        streams = {}
+        noise = []
+        for j, fs in enumerate(filts):
+            if fs not in streams:
+                #Position and epoch within the position of each epoch of the cadence
+                offsets = num.asarray(cadences[fs][2])
+                counts = num.diff(offsets)
+                posid = num.repeat(num.arange(len(counts)), counts)
+                counter = num.arange(offsets[-1] - offsets[0]) - num.repeat(offsets[:-1] - offsets[0], counts)
+                streams[fs] = (posid + start, counter)
+            posid, counter = streams[fs]
+            noise.append(normalPairs(seed, posid, j, counter))
+        return noise
+
+    def realizePosition(self, i, filts, cadences, doAddErr = False, mutils = None, blocknoise = None):
+        '''
+        Realize each TimeSeries at one position of a block from its cadence.  The TimeSeries in each
+        filter share that filter's cadence, so their photometric errors are computed together by realizeErrors.
+        Inputs:
+        i -- index of the position in the block
+        filts -- filter of each TimeSeries, see getFilter
+        cadences -- cadences of the block keyed by filter, see fetchCadences
+        doAddErr -- as for Realize
+        blocknoise -- noise of the block as returned by drawNoise; if None the noise is drawn from numpy's
+                      global random state
+        Return:
+        list with, for each TimeSeries, None if the position was not observed, else the arrays
+        (time, mag, magerrbright, magerrdim, m5) of the realization
+        '''
+        if mutils is None:
+            mutils = MagUtils()
+        realized = [None]*len(self.tss)
+        #Group the TimeSeries by filter, keeping the order of first appearance
+        groups = OrderedDict()
+        for j, fs in enumerate(filts):
+            groups.setdefault(fs, []).append(j)
+        noise = {}
+        if doAddErr:
+            #Draw the noise of each TimeSeries in TimeSeries order, so that a given seed gives the same
+            #realizations however the TimeSeries are grouped
+            for j, fs in enumerate(filts):
+                (times, m5s, offsets) = cadences[fs]
+                n = offsets[i+1] - offsets[i]
+                if n > 0 and blocknoise is not None:
+                    lo = offsets[i] - offsets[0]
+                    noise[j] = (blocknoise[j][0][lo:lo+n], blocknoise[j][1][lo:lo+n])
+                elif n > 0:
+                    noise[j] = (num.random.normal(0,1,n), num.random.normal(0,1,n))
+        for fs, models in groups.items():
+            (times, m5s, offsets) = cadences[fs]
+            time = times[offsets[i]:offsets[i+1]]
+            m5 = m5s[offsets[i]:offsets[i+1]]
+            #If no data in database leave None in the output
+            if len(time) == 0:
+                continue
+            #The realizations of every model in this filter share these views of the cadence, read only
+            time.flags.writeable = False
+            m5.flags.writeable = False
+            #Interpolated flux values based on time sampling from database, one row per TimeSeries
+            fluxes = num.zeros((len(models), len(time)))
+            windows = []
+            #Models which can be evaluated together, such as copies of a template sharing its spline
+            #(see TimeSeriesMag.expand) or templates of one TemplateLibrary, are evaluated in one call
+            families = OrderedDict()
+            for k, j in enumerate(models):
+                ts = self.tss[j]
+                if hasattr(ts, 'getFamilyKey') and ts.getFamilyKey() is not None:
+                    families.setdefault(ts.getFamilyKey(), []).append(k)
+            shared = set()
+            for rows in families.values():
+                if len(rows) < 2:
+                    continue
+                family = [self.tss[models[k]] for k in rows]
+                mags, inside = family[0].evaluateFamily(family, time, fs)
+                fluxes[rows] = mags
+                if not inside.all():
+                    windows.append((rows, ~inside))
+                shared.update(rows)
+            for k, j in enumerate(models):
+                if k in shared:
+                    continue
+                ts = self.tss[j]
+                #Non periodic sources are only evaluated at the epochs of the (time ordered) cadence
+                #inside their window and have no flux at the others
+                window = ts.getWindow()
+                if window is None:
+                    lo, hi = 0, len(time)
+                else:
+                    lo, hi = num.searchsorted(time, window[0], 'left'), num.searchsorted(time, window[1], 'right')
+                    outside = num.ones(len(time), dtype=bool)
+                    outside[lo:hi] = False
+                    windows.append(([k], outside))
+                if isinstance(ts, TimeSeriesMag):
+                    fluxes[k, lo:hi] = ts.evaluate(time[lo:hi])
+                else:
+                    fluxes[k, lo:hi] = ts.evaluate(time[lo:hi], filt=fs)
+            mutils.toFluxIdx(fluxes, filterIndex(fs), out=fluxes)
+            for rows, outside in windows:
+                fluxes[rows] = num.where(outside, 0., fluxes[rows])
+            draws = None
+            if doAddErr:
+                draws = num.array([[noise[j][0] for j in models], [noise[j][1] for j in models]])
+            (mags, magerrfp, magerrfm) = self.realizeErrors(fluxes, m5, fs, draws, mutils)
+            #Append resampled epochs to output list
+            for k, j in enumerate(models):
+                realized[j] = (time, mags[k], magerrfp[k], magerrfm[k], m5)
+        return realized
+
+    def realizeErrors(self, fluxes, m5, fs, noise = None, mutils = None):
+        '''
+        Calculate the photometric errors of a set of models sampled on one cadence, optionally adding
+        random errors to their fluxes.  The magnitudes are asinh magnitudes, see MagUtils, and are worked
+        with as k*arcsinh(flux/(2 b f0)) throughout so each transcendental is evaluated once per epoch.
+        Inputs:
+        fluxes -- (nmodels, nepochs) array of model fluxes at the epochs of the cadence
+        m5 -- array of nepochs 5 sigma limiting magnitudes of the cadence
+        fs -- filter string
+        noise -- None to return magnitudes uncorrected for errors, or a (2, nmodels, nepochs) array of
+                 unit normal deviates scaling the random (1 sigma at m5/5) and systematic (0.01 mag) errors
+        Return:
+        (mag, magerrbright, magerrdim) -- (nmodels, nepochs) arrays; errors are -9999 for detections
+                                          below 1 sigma
+        '''
+        if mutils is None:
+            mutils = MagUtils()
+        k = 2.5/num.log(10.)
+        b = mutils.getSoftening(fs)
+        scale = 2.*b*mutils.getZeroPoint()
+        m5 = num.asarray(m5, dtype=float)
+        #Flux of a 1 sigma detection, in units of scale
+        m1flux = mutils.toFluxIdx(m5, filterIndex(fs))
+        m1flux /= 5.*scale
+        u = num.array(fluxes, dtype=float)
+        u /= scale
+        if noise is not None:
+            #The systematic error of 0.01 magnitudes as a flux: sinh(arcsinh(u) + c) - u
+            c = 0.01/k
+            sysfluxerr = u*(num.cosh(c) - 1.)
+            sysfluxerr += num.sqrt(1. + u*u)*num.sinh(c)
+            sysfluxerr *= noise[1]
+            u += m1flux*noise[0]
+            u += sysfluxerr
+            del sysfluxerr
+        asu = num.arcsinh(u)
+        mag = asu + num.log(b)
+        mag *= -k
+        sigs = u/m1flux
+        #Errors from the flux of a 1 sigma detection either side of the realized flux
+        magerrfp = num.arcsinh(u + m1flux)
+        magerrfp -= asu
+        magerrfp *= k
+        magerrfm = num.arcsinh(u - m1flux, out=u)
+        magerrfm -= asu
+        magerrfm *= -k
+        del asu
+        #Errors from the 5 sigma limiting magnitude, including the systematic error in quadrature
+        x = mag - m5
+        x *= 0.4
+        x = num.power(10., x, out=x)
+        gamma = self.gamma[fs]
+        magerr = x*gamma
+        magerr += 0.04 - gamma
+        magerr *= x
+        magerr += 0.01**2
+        magerr = num.sqrt(magerr, out=magerr)
+        #at S/N > 10 the errors from flux differ from those calculated from the m5 by less
+        #than the systematic error of 0.01 mag
+        bright = sigs > 10
+        magerrfp[bright] = magerr[bright]
+        magerrfm[bright] = magerr[bright]
+        #if the detection is < 1 sigma indicate this by setting error to -9999
+        faint = sigs < 1
+        magerrfp[faint] = -9999
+        magerrfm[faint] = -9999
+        return mag, magerrfp, magerrfm
+
+    def realizeCadences(self, ras, decs, filts, cadences, doAddErr = False, seed = None, start = 0):
+        '''
+        Realize each TimeSeries at a set of positions from their cadences
+        Inputs:
+        ras -- array of RA values in degrees
+        decs -- array of Declination values in degrees
+        filts -- filter of each TimeSeries, see getFilter
+        cadences -- cadences of the positions keyed by filter, see fetchCadences
+        doAddErr, seed -- as for Realize
+        start -- index of the first position among all positions realized, see drawNoise
+        Return:
+        list of LightCurve objects, one per position
+        '''
         mutils = MagUtils()
+        blocknoise = None
+        if doAddErr and seed is not None:
+            blocknoise = self.drawNoise(seed, start, filts, cadences)
         lc = []
         #Loop over positions for each TimeSeries
-        for ra,dec in zip(ras,decs):
+        for i in range(len(ras)):
+            ra = ras[i]
+            dec = decs[i]
             tsi = []
-            #Loop over TimeSeries array
-            for ts in self.tss:
-                isTimeSeries = isinstance(ts, TimeSeriesMag)
-                tmpmag = []
-                #Filter string
-                if isTimeSeries:
-                    fs = ts.getFilter().lower()
-                    if filtstr != None:
-                        assert filtstr == fs, "Filter specified in constructor does not match that from the TimeSeries object"
-                else:
-                    fs = filtstr
-                if fs not in self.gamma:
-                    #We only know sloan filters, so if something different assume r
-                    print "Don't know parameters for filter",fs,"\n Assuming r..."
-                    fs = 'r'
-                #Get time sampling and 5 sigma limiting magnitude information from the database
-                (time, m5) = db.getTimeMagSQL(ra, dec, fs, doDith, version)
+            for fs, arrays in zip(filts, self.realizePosition(i, filts, cadences, doAddErr, mutils, blocknoise)):
                 #If no data in database return a None object
-                if len(time) == 0:
+                if arrays is None:
                     tsi.append(TimeSeriesMag(None, None, None, None, fs, calcspline = False, ra = ra, dec = dec))
                     continue
-                #Interpolatd flux values based on time sampling from database
-                if isTimeSeries:
-                    fluxinterp = mutils.toFluxArr(ts.evaluate(time), fs)
-                else:
-                    fluxinterp = mutils.toFluxArr(ts.evaluate(time, filt=fs), fs)
-
-                #Calculate total photometric error from interpolated magnitudes and 5 sigma limiting magnitues.
-                #Systematic error is assumed to be 0.01 magnitudes 
-                m1flux = mutils.toFluxArr(m5, fs)/5.
-                sysmag = (mutils.toMagArr(fluxinterp, fs) - 0.01)
-                sysfluxerr = mutils.toFluxArr(sysmag, fs) - fluxinterp 
-                sigs = []
-                magerrfp = []
-                magerrfm = []
-                tmpflux = []
-                if doAddErr:
-                    #Add random error to interpolated magnitudes
-                    tmpflux = fluxinterp + m1flux*num.random.normal(0,1,len(m1flux))
-                    tmpflux = tmpflux + sysfluxerr*num.random.normal(0,1,len(sysfluxerr))
-                    tmpmag = mutils.toMagArr(tmpflux, fs)
-                    sigs = tmpflux/m1flux
-                else:
-                    tmpflux = fluxinterp
-                    tmpmag = mutils.toMagArr(tmpflux, fs)
-                    sigs = tmpflux/m1flux
-
-                x = 10.0**(0.4*(tmpmag-m5))
-                magerr = num.sqrt((0.04 - self.gamma[fs])*x + self.gamma[fs]*x**2)
-                magerr = num.sqrt(magerr**2 + 0.01**2)
-
-                magerrfp = tmpmag - mutils.toMagArr(tmpflux + m1flux, fs)
-                magerrfm = mutils.toMagArr(tmpflux - m1flux, fs) - tmpmag
-
-                #at S/N > 10 the errors from flux differ from those calculated from the m5 by less
-                #than the systematic error of 0.01 mag
-                magerrfp = num.where(sigs > 10, magerr, magerrfp)
-                magerrfm = num.where(sigs > 10, magerr, magerrfm)
-
-                #if the detection is < 1 sigma indicate this by setting error to -9999
-                magerrfp = num.where(sigs < 1, -9999, magerrfp)
-                magerrfm = num.where(sigs < 1, -9999, magerrfm)
+                (time, mag, magerrfp, magerrfm, m5) = arrays
                 #Append resampled TimeSeries to output list of TimeSeries
-                tsi.append(TimeSeriesMag(time, tmpmag, magerrfp, magerrfm, fs, calcspline = False, ra = ra, dec = dec, m5 = m5))
+                tsi.append(TimeSeriesMag(time, mag, magerrfp, magerrfm, fs, calcspline = False, ra = ra, dec = dec, m5 = m5))
             #Append LightCurve for each ra/dec location 
             lc.append(LightCurve(tsi, self.isperiodic))
-        db.close()
         return lc
+
+    def realizeTable(self, ras, decs, filts, cadences, doAddErr = False, seed = None, start = 0):
+        '''
+        Realize each TimeSeries at a set of positions from their cadences into a RealizationTable
+        Inputs:
+        as for realizeCadences
+        Return:
+        RealizationTable of the positions
+        '''
+        mutils = MagUtils()
+        blocknoise = None
+        if doAddErr and seed is not None:
+            blocknoise = self.drawNoise(seed, start, filts, cadences)
+        cols = [[] for name in RealizationTable.columns]
+        counts = []
+        for i in range(len(ras)):
+            for arrays in self.realizePosition(i, filts, cadences, doAddErr, mutils, blocknoise):
+                if arrays is None:
+                    counts.append(0)
+                    continue
+                counts.append(len(arrays[0]))
+                for col, arr in zip(cols, arrays):
+                    col.append(arr)
+        offsets = num.zeros(len(counts) + 1, dtype=num.int64)
+        offsets[1:] = num.cumsum(counts)
+        arrays = [num.concatenate(col) if col else num.zeros(0) for col in cols]
+        return RealizationTable(ras, decs, filts, offsets, *arrays)
+
+    def _iterParallel(self, ras, decs, blocks, workers, db, start = 0, **kwargs):
+        '''
+        Realize blocks of positions in a pool of worker processes, yielding the realizations of each
+        block in input order.  Up to two blocks per worker are in flight at once.
+        The db is pickled and each worker opens its own handle on it; if None each worker connects
+        to the default database.  The LightCurve, with its models, is handed to each worker once when the
+        worker starts, so a task carries only its positions.
+        '''
+        dbstate = None
+        if db is not None:
+            dbstate = pickle.dumps(db, pickle.HIGHEST_PROTOCOL)
+        pool = multiprocessing.Pool(workers, _initWorker, (dbstate, self))
+        finished = False
+        try:
+            pending = deque()
+            depth = 2*workers
+            for lo, hi in blocks[:depth]:
+                pending.append(pool.apply_async(_realizeShard, ((ras[lo:hi], decs[lo:hi], dict(kwargs, start=start + lo)),)))
+            for n in range(len(blocks)):
+                lc = pending.popleft().get()
+                if n + depth < len(blocks):
+                    lo, hi = blocks[n + depth]
+                    pending.append(pool.apply_async(_realizeShard, ((ras[lo:hi], decs[lo:hi], dict(kwargs, start=start + lo)),)))
+                yield lc
+            finished = True
+        finally:
+            #Idle workers are let exit; workers are only killed if the caller stopped early
+            if finished:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
@@ -3,9 +3,31 @@
     Jan 2008 by K. Simon Krughoff krughoff@astro.washington.edu\
     Modified:
     March 2011 by K. Simon Krughoff fixes of docs.
+    The *Idx kernels take an array of filter indices (see filterIndex) alongside the magnitudes or
+    fluxes, so epochs in any mix of filters are converted in one call.
 '''
 import numpy as num
 
+#Filters in index order
+FILTERS = ['u', 'g', 'r', 'i', 'z', 'y']
+
+def filterIndex(filts):
+    ''' Return the index (or int8 array of indices) into FILTERS of a filter string (or sequence of them).
+        Filters not in FILTERS get the index len(FILTERS), which has the default softening parameter.
+    '''
+    if isinstance(filts, basestring):
+        if filts in FILTERS:
+            return FILTERS.index(filts)
+        return len(FILTERS)
+    return num.array([filterIndex(f) for f in filts], dtype=num.int8)
+
+def _buffer(values, out):
+    #Copy values into out, or into a new float array if out is None, for the kernels to work on in place
+    if out is None:
+        return num.array(values, dtype=float)
+    out[...] = values
+    return out
+
 class MagUtils:
     #This is just a guess at the softening parameter for the ASINH magnitude system.  
     #In reality, this should be related to the average sky and should vary with filter.
@@ -13,35 +35,66 @@ class MagUtils:
     _b = dict(u = 1.26e-10, g = 3.17e-11, r = 3.17e-11, i = 7.96e-11, z = 1.26e-10, y = 3.17e-10)
     #Zero magnitude flux density by definition is 3631Jy in the AB mag system
     _fo = 3631
+    #Softening parameter and its log by filter index, the last entry for unknown filters
+    _bIdx = num.array([_b[f] for f in FILTERS] + [1.e-11])
+    _logbIdx = num.log(_bIdx)
     def getZeroPoint(self):
         #Get flux density zeropoint value for calculating fluxes for this time series
         return float(self._fo)
-    def toFluxArr(self, mags, fs):
-      b = None
-      if(self._b.has_key(fs)):
-        b = self._b[fs]
-      else:
-        b = 1.e-11
-      return num.asarray(self._fo*2.*b*num.sinh(mags/(-2.5/num.log(10.)) - num.log(b)))
-    def toMagArr(self, fluxs, fs):
-      b = None
-      if(self._b.has_key(fs)):
-        b = self._b[fs]
-      else:
-        b = 1.e-11
-      return num.asarray(-(2.5/num.log(10.))*(num.arcsinh((fluxs/self._fo)/(2.*b)) + num.log(b)))
+    def getSoftening(self, fs):
+        #Get the softening parameter of the asinh magnitudes in filter fs
+        return self._bIdx[filterIndex(fs)]
+    def toFluxArr(self, mags, fs, out=None):
+      b = self.getSoftening(fs)
+      out = _buffer(mags, out)
+      out /= -2.5/num.log(10.)
+      out -= num.log(b)
+      num.sinh(out, out=out)
+      out *= self._fo*2.*b
+      return out
+    def toMagArr(self, fluxs, fs, out=None):
+      b = self.getSoftening(fs)
+      out = _buffer(fluxs, out)
+      out /= self._fo
+      out /= 2.*b
+      num.arcsinh(out, out=out)
+      out += num.log(b)
+      out *= -(2.5/num.log(10.))
+      return out
+    def toFluxIdx(self, mags, filtidx, out=None):
+      '''
+      Convert magnitudes in a mix of filters to fluxes
+      Inputs:
+      mags -- array of magnitudes
+      filtidx -- filter index of each magnitude, broadcastable against mags (see filterIndex)
+      out -- optional array to write the fluxes to; may be mags itself
+      '''
+      b = self._bIdx[filtidx]
+      out = _buffer(mags, out)
+      out /= -2.5/num.log(10.)
+      out -= self._logbIdx[filtidx]
+      num.sinh(out, out=out)
+      out *= self._fo*2.*b
+      return out
+    def toMagIdx(self, fluxs, filtidx, out=None):
+      '''
+      Convert fluxes in a mix of filters to magnitudes
+      Inputs:
+      fluxs -- array of fluxes
+      filtidx -- filter index of each flux, broadcastable against fluxs (see filterIndex)
+      out -- optional array to write the magnitudes to; may be fluxs itself
+      '''
+      b = self._bIdx[filtidx]
+      out = _buffer(fluxs, out)
+      out /= self._fo
+      out /= 2.*b
+      num.arcsinh(out, out=out)
+      out += self._logbIdx[filtidx]
+      out *= -(2.5/num.log(10.))
+      return out
     def toFlux(self, mag, fs):
-      b = None
-      if(self._b.has_key(fs)):
-        b = self._b[fs]
-      else:
-        b = 1.e-11
+      b = self.getSoftening(fs)
       return self._fo*2.*b*num.sinh(mag/(-2.5/num.log(10.)) - num.log(b))
     def toMag(self, flux, fs):
-      b = None
-      if(self._b.has_key(fs)):
-        b = self._b[fs]
-      else:
-        b = 1.e-11
+      b = self.getSoftening(fs)
       return -(2.5/num.log(10.))*(num.arcsinh((flux/self._fo)/(2.*b)) + num.log(b))
-
@@ -0,0 +1,62 @@
+''' Counter based random streams for the noise of seeded realizations.
+    Every (position, model) pair realized by a seeded Realize has its own stream of unit normal deviates.
+    Deviate pair n of a stream is a pure function of (seed, position index, model index, n): the four are
+    hashed into 64 random bits by the splitmix64 mixing function and the bits turned into two normal
+    deviates by the Box-Muller transform.  Streams need no state, so the noise of a position does not
+    depend on how the positions are split into blocks or over workers, nor on the order they are
+    realized in, and the noise of a whole block is drawn with a few vectorized array operations.
+    (numpy's Generator and SeedSequence.spawn would do the same but need numpy 1.17 or later.)
+'''
+import numpy as num
+
+#splitmix64 constants
+_golden = num.uint64(0x9E3779B97F4A7C15)
+_mul1 = num.uint64(0xBF58476D1CE4E5B9)
+_mul2 = num.uint64(0x94D049BB133111EB)
+
+def _mix(z):
+    #splitmix64 finalizer of an array of uint64; products wrap modulo 2**64
+    z = z ^ (z >> num.uint64(30))
+    z *= _mul1
+    z ^= z >> num.uint64(27)
+    z *= _mul2
+    z ^= z >> num.uint64(31)
+    return z
+
+def _asUint64(values):
+    return num.atleast_1d(num.asarray(values, dtype=num.int64)).astype(num.uint64)
+
+def streamKeys(seed, positions, models):
+    '''
+    Return the 64 bit key of the stream of each (position, model) pair
+    Inputs:
+    seed -- non negative integer seed of the run
+    positions -- array of position indices
+    models -- array of model indices, broadcast against positions
+    '''
+    key = _mix(num.array([int(seed)%2**64], dtype=num.uint64) + _golden)
+    key = _mix(key + _golden*(_asUint64(positions) + num.uint64(1)))
+    return _mix(key + _golden*(_asUint64(models) + num.uint64(1)))
+
+def normalPairs(seed, positions, models, counters):
+    '''
+    Draw unit normal deviates from the streams of (position, model) pairs
+    Inputs:
+    seed -- non negative integer seed of the run
+    positions -- array of the position index of each deviate pair
+    models -- array of the model index of each deviate pair, broadcast against positions
+    counters -- array of the index of each deviate pair within its stream, broadcast against positions
+    Return:
+    (2, n) array of unit normal deviates; the two rows are independent
+    '''
+    key = streamKeys(seed, positions, models)
+    counters = _asUint64(counters)*num.uint64(2)
+    bits1 = _mix(key + _golden*(counters + num.uint64(1)))
+    bits2 = _mix(key + _golden*(counters + num.uint64(2)))
+    #Uniform deviates from the top 53 bits, in (0, 1] for the logarithm and [0, 1) for the angle
+    u1 = ((bits1 >> num.uint64(11)) + num.uint64(1)).astype(float)
+    u1 *= 2.**-53
+    u2 = (bits2 >> num.uint64(11)).astype(float)
+    u2 *= 2.*num.pi*2.**-53
+    radius = num.sqrt(-2.*num.log(u1))
+    return num.array([radius*num.cos(u2), radius*num.sin(u2)])
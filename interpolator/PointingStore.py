@@ -0,0 +1,451 @@
+''' Local, memory mapped columnar snapshot of the OpSim pointing tables.
+    A store is a directory holding one sub-directory per run table (output_opsim3_61, output_opsim1_29,
+    output_opsim5_72 and pointing_meta).  Each run directory holds one .npy file per column:
+    expMJD, filter, fieldra, fielddec, hexdithra, hexdithdec and m5.  Angles are kept in radians
+    as in the database tables.
+    Alongside the columns, the distinct field centers of a run are written to fieldcenters.npy with
+    fieldrows.npy listing the exposures grouped by field and fieldoffsets.npy delimiting each group.
+    The distinct dithered centers are indexed the same way in hexdithcenters.npy, hexdithrows.npy and
+    hexdithoffsets.npy, written on import or on first dithered use of a run.
+    The PointingStore class has the same getTimeMagSQL contract as the DB class so it may be passed
+    to LightCurve.Realize in place of a database connection.  Covering fields, or dithered centers,
+    are found through a FieldIndex over the centers so only the exposures of those are touched, and
+    dithered and undithered lookups of any run take the same path at the same cost.
+    getTimeMagFilterBatch gathers the exposures of the covering fields once for all requested filters
+    and splits them by filter code in the same pass.
+    Positions covered by the same set of fields have the same cadence, so the batch methods resolve
+    positions to their field sets with getFieldSets, compute the cadence of each distinct field set once
+    with getFieldSetCadences and hand it to every position of that set.  With doDith the sets are sets
+    of dithered centers.  FieldSetCache keeps the field
+    set cadences across calls.
+    importRun, importSQLite and importDump build the snapshot of a run from a database connection,
+    a local SQLite copy of the tables or a tab separated dump of the table respectively.
+'''
+import os
+import sqlite3
+import tempfile
+import numpy as num
+from DB import getRunTable, _uniqueFilters
+from FieldIndex import FieldIndex
+from NoiseStreams import _mix, _golden
+
+#Columns held for each run, in the order used for imports and dumps
+COLUMNS = ['expMJD', 'filter', 'fieldra', 'fielddec', 'hexdithra', 'hexdithdec', 'm5']
+_dtypes = dict(expMJD = num.float64, filter = 'S1', fieldra = num.float64, fielddec = num.float64,
+               hexdithra = num.float64, hexdithdec = num.float64, m5 = num.float64)
+#Prefix of the center columns and index files of the undithered (False) and dithered (True) pointings
+_prefixes = {False: 'field', True: 'hexdith'}
+
+def _distinctBatch(posid, time, m5, npos):
+    ''' Return the distinct (time, m5) pairs of each position sorted by time, with per position offsets '''
+    order = num.lexsort((m5, time, posid))
+    posid = posid[order]
+    time = time[order]
+    m5 = m5[order]
+    keep = num.ones(len(time), dtype=bool)
+    keep[1:] = (posid[1:] != posid[:-1]) | (time[1:] != time[:-1]) | (m5[1:] != m5[:-1])
+    offsets = num.zeros(npos + 1, dtype=int)
+    offsets[1:] = num.cumsum(num.bincount(posid[keep], minlength=npos))
+    return time[keep], m5[keep], offsets
+
+def _raggedRange(starts, stops):
+    ''' Concatenation of arange(start, stop) for each start, stop pair without a Python loop '''
+    lengths = num.asarray(stops) - num.asarray(starts)
+    ends = num.cumsum(lengths)
+    return num.repeat(starts - (ends - lengths), lengths) + num.arange(ends[-1] if len(ends) else 0)
+
+def _groupByCenter(cra, cdec):
+    ''' Group exposures by pointing center
+    Inputs:
+    cra -- RA of the pointing center of each exposure
+    cdec -- declination of the pointing center of each exposure
+    Return:
+    centers -- (ncenter, 2) array of the distinct ra, dec centers
+    rows -- exposure indices grouped by center; the stable sort keeps each group in time order
+    offsets -- array of ncenter+1 offsets; the exposures of center i are rows[offsets[i]:offsets[i+1]]
+    '''
+    cra = num.asarray(cra)
+    cdec = num.asarray(cdec)
+    rows = num.lexsort((cdec, cra))
+    sra = cra[rows]
+    sdec = cdec[rows]
+    isnew = num.ones(len(rows), dtype=bool)
+    isnew[1:] = (sra[1:] != sra[:-1]) | (sdec[1:] != sdec[:-1])
+    starts = num.flatnonzero(isnew)
+    offsets = num.append(starts, len(rows))
+    return num.column_stack((sra[starts], sdec[starts])), rows, offsets
+
+def _saveAtomic(filename, array):
+    #Written under a temporary name and renamed so readers never see a partial file
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), suffix='.npy')
+    fh = os.fdopen(fd, 'wb')
+    try:
+        num.save(fh, array)
+    finally:
+        fh.close()
+    os.rename(tmpname, filename)
+
+def _writeIndex(rundir, prefix, cra, cdec):
+    ''' Write the pointing center grouping of a run.  The centers file is renamed into place last, so once it
+        exists the whole grouping may be read, and threads or processes writing the same grouping at once
+        only replace complete files with identical ones.
+    '''
+    centers, rows, offsets = _groupByCenter(cra, cdec)
+    _saveAtomic(os.path.join(rundir, prefix + 'rows.npy'), rows)
+    _saveAtomic(os.path.join(rundir, prefix + 'offsets.npy'), offsets)
+    _saveAtomic(os.path.join(rundir, prefix + 'centers.npy'), centers)
+
+def _firstAppearance(items):
+    #Number the distinct items in order of first appearance; returns the number of each item and the first
+    #index of each distinct item
+    dumUnique, firsts, inverse = num.unique(items, return_index=True, return_inverse=True)
+    order = num.argsort(firsts)
+    rank = num.empty(len(order), dtype=int)
+    rank[order] = num.arange(len(order))
+    return rank[inverse], firsts[order]
+
+def _uniqueRows(values, offsets):
+    ''' Number the distinct rows of a ragged array in order of first appearance
+    Inputs:
+    values -- non negative integers of all rows, concatenated
+    offsets -- array of nrows+1 offsets; row i is values[offsets[i]:offsets[i+1]]
+    Return:
+    rowid -- index of the distinct row equal to each row
+    firsts -- index of the first row equal to each distinct row
+    '''
+    nrows = len(offsets) - 1
+    if nrows == 0:
+        return num.zeros(0, dtype=int), num.zeros(0, dtype=int)
+    values = num.asarray(values)
+    offsets = num.asarray(offsets)
+    lengths = num.diff(offsets)
+    within = _raggedRange(num.zeros(nrows, dtype=int), lengths)
+    #64 bit hash of each row: the sum, wrapping, of a hash of each value and its place in the row, mixed
+    #with the row length
+    hashes = _mix(values.astype(num.uint64) + _golden*(within.astype(num.uint64) + num.uint64(1)))
+    sums = num.zeros(len(values) + 1, dtype=num.uint64)
+    num.cumsum(hashes, out=sums[1:])
+    rowid, firsts = _firstAppearance(_mix(sums[offsets[1:]] - sums[offsets[:-1]] + _golden*lengths.astype(num.uint64)))
+    #Rows of equal hash are checked to be equal; on a collision the rows are compared whole instead
+    rep = firsts[rowid]
+    if (lengths[rep] == lengths).all() and (values[offsets[rep].repeat(lengths) + within] == values).all():
+        return rowid, firsts
+    padded = num.empty((nrows, lengths.max()), dtype=values.dtype)
+    padded.fill(-1)
+    padded[num.repeat(num.arange(nrows), lengths), within] = values
+    return _firstAppearance(padded.view(num.dtype((num.void, padded.dtype.itemsize*padded.shape[1]))).ravel())
+
+def _expandSets(time, m5, setoffsets, setid):
+    ''' Pack the cadences of field sets delimited by setoffsets into per position cadences, position i having
+        the cadence of field set setid[i]
+    '''
+    starts = setoffsets[setid]
+    stops = setoffsets[setid + 1]
+    idx = _raggedRange(starts, stops)
+    offsets = num.zeros(len(setid) + 1, dtype=int)
+    offsets[1:] = num.cumsum(stops - starts)
+    return time[idx], m5[idx], offsets
+
+def _normalize(ras, decs):
+    ''' Wrap RA into [0, 360) and clip declination to [-90, 90] degrees '''
+    ras = num.atleast_1d(num.asarray(ras, dtype=float))%360.
+    decs = num.clip(num.atleast_1d(num.asarray(decs, dtype=float)), -90., 90.)
+    return ras, decs
+
+def _writeRun(root, simtab, cols):
+    ''' Write the columns of a run to the store at root '''
+    rundir = os.path.join(root, simtab)
+    if not os.path.isdir(rundir):
+        os.makedirs(rundir)
+    #Keep the exposures in time order so selections come back nearly sorted
+    order = num.argsort(cols['expMJD'], kind='mergesort')
+    for name in COLUMNS:
+        cols[name] = num.asarray(cols[name], dtype=_dtypes[name])[order]
+        num.save(os.path.join(rundir, name + '.npy'), cols[name])
+    for prefix in _prefixes.values():
+        _writeIndex(rundir, prefix, cols[prefix + 'ra'], cols[prefix + 'dec'])
+    return rundir
+
+def importRun(conn, root, version="opsim3_61", chunksize=100000):
+    ''' Build the snapshot of a run from an open DB-API connection (MySQLdb or sqlite3)
+    Inputs:
+    conn -- DB-API connection to a database holding the OpSim run tables
+    root -- directory of the store
+    version -- version of the operation simulator to import
+    chunksize -- number of rows to fetch from the database at a time
+    Return:
+    directory holding the columns of the imported run
+    '''
+    simtab, m5col = getRunTable(version)
+    cursor = conn.cursor()
+    cursor.execute("select expMJD, filter, fieldra, fielddec, hexdithra, hexdithdec, `%s` from %s"%(m5col, simtab))
+    rows = []
+    while True:
+        result = cursor.fetchmany(chunksize)
+        if not result:
+            break
+        rows.extend(result)
+    cursor.close()
+    cols = {}
+    if len(rows) == 0:
+        for name in COLUMNS:
+            cols[name] = num.zeros(0, dtype=_dtypes[name])
+    else:
+        #The star is very important
+        for name, col in zip(COLUMNS, zip(*rows)):
+            if name == 'filter':
+                col = [str(f) for f in col]
+            cols[name] = num.asarray(col, dtype=_dtypes[name])
+    return _writeRun(root, simtab, cols)
+
+def importSQLite(dbfile, root, version="opsim3_61"):
+    ''' Build the snapshot of a run from a local SQLite copy of the OpSim tables
+    Inputs:
+    dbfile -- SQLite database file
+    root -- directory of the store
+    version -- version of the operation simulator to import
+    Return:
+    directory holding the columns of the imported run
+    '''
+    conn = sqlite3.connect(dbfile)
+    try:
+        return importRun(conn, root, version)
+    finally:
+        conn.close()
+
+def importDump(dumpfile, root, version="opsim3_61"):
+    ''' Build the snapshot of a run from a whitespace separated dump of the run table, as written by
+    mysql -B -N -e "select expMJD, filter, fieldra, fielddec, hexdithra, hexdithdec, 5sigma_ps from output_opsim3_61"
+    Inputs:
+    dumpfile -- text file with the columns expMJD, filter, fieldra, fielddec, hexdithra, hexdithdec and m5
+    root -- directory of the store
+    version -- version of the operation simulator the dump was taken from
+    Return:
+    directory holding the columns of the imported run
+    '''
+    simtab, m5col = getRunTable(version)
+    dtype = [(name, _dtypes[name]) for name in COLUMNS]
+    data = num.atleast_1d(num.loadtxt(dumpfile, dtype=dtype, comments='#'))
+    cols = dict([(name, data[name]) for name in COLUMNS])
+    return _writeRun(root, simtab, cols)
+
+class PointingStore:
+    ''' Class for retrieving time sampling from a local snapshot of the OpSim pointings '''
+    pointing_radius_deg = 1.75
+    def __init__(self, root):
+        '''
+        Open the store in directory root.  Run tables are memory mapped on first use.
+        Inputs:
+        root -- directory of the store, as written by importRun, importSQLite or importDump
+        '''
+        self.root = root
+        self._runs = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *dumArgs):
+        self._runs = None
+
+    def close(self):
+        '''Release the memory mapped runs; may be safely called even if already closed'''
+        self.__exit__()
+
+    def isOpen(self):
+        return self._runs != None
+
+    def __getstate__(self):
+        #Only the location is pickled; an unpickled store maps the runs again on first use
+        return {'root': self.root}
+
+    def __setstate__(self, state):
+        self.__init__(state['root'])
+
+    def getRun(self, version):
+        ''' Return a dictionary of the memory mapped columns for a run '''
+        simtab, m5col = getRunTable(version)
+        if simtab not in self._runs:
+            rundir = os.path.join(self.root, simtab)
+            run = {}
+            for name in COLUMNS:
+                run[name] = num.load(os.path.join(rundir, name + '.npy'), mmap_mode='r')
+            run['dir'] = rundir
+            self._runs[simtab] = run
+        return self._runs[simtab]
+
+    def getCenters(self, version, doDith=False):
+        '''
+        Return the grouping of the exposures of a run by pointing center
+        Inputs:
+        version -- version of the operation simulator
+        doDith -- False for the field centers, True for the dithered centers
+        Return:
+        index -- FieldIndex over the distinct centers
+        rows -- exposure indices grouped by center
+        offsets -- the exposures of center i are rows[offsets[i]:offsets[i+1]]
+        '''
+        run = self.getRun(version)
+        prefix = _prefixes[bool(doDith)]
+        if prefix + 'index' not in run:
+            rundir = run['dir']
+            if not os.path.exists(os.path.join(rundir, prefix + 'centers.npy')):
+                #Snapshot written without this grouping
+                _writeIndex(rundir, prefix, run[prefix + 'ra'], run[prefix + 'dec'])
+            for name in ['rows', 'offsets']:
+                run[prefix + name] = num.load(os.path.join(rundir, prefix + name + '.npy'), mmap_mode='r')
+            centername = os.path.join(rundir, prefix + 'centers.npy')
+            #The centers file is replaced whenever the run is imported again, changing its inode and mtime
+            info = os.stat(centername)
+            run[prefix + 'snapshot'] = '%s:%s:%d:%d:%r'%(os.path.abspath(rundir), prefix, info.st_ino,
+                                                         info.st_size, info.st_mtime)
+            centers = num.load(centername)
+            run[prefix + 'index'] = FieldIndex(centers[:,0], centers[:,1])
+        return run[prefix + 'index'], run[prefix + 'rows'], run[prefix + 'offsets']
+
+    def getSnapshotId(self, version, doDith=False):
+        ''' Return a string identifying the snapshot of a run whose center grouping numbers the field sets
+            of getFieldSets, so that field sets of different stores or imports are never confused
+        '''
+        self.getCenters(version, doDith)
+        return self.getRun(version)[_prefixes[bool(doDith)] + 'snapshot']
+
+    def getFilterGroups(self, version, filt, doDith=False):
+        ''' Return the exposures of a run in one filter grouped by center, with per center offsets '''
+        run = self.getRun(version)
+        key = (_prefixes[bool(doDith)], filt)
+        if key not in run:
+            index, rows, offsets = self.getCenters(version, doDith)
+            sel = run['filter'][rows] == filt
+            #Number of exposures in the filter before each group boundary
+            nsel = num.zeros(len(sel) + 1, dtype=int)
+            nsel[1:] = num.cumsum(sel)
+            run[key] = (num.asarray(rows[sel]), nsel[offsets])
+        return run[key]
+
+    def getFilterCodes(self, version, filts):
+        ''' Return the index into filts of the filter of each exposure of a run, -1 for other filters '''
+        run = self.getRun(version)
+        if 'filterletters' not in run:
+            run['filterletters'], run['filterinverse'] = num.unique(run['filter'], return_inverse=True)
+        lut = num.array([filts.index(f) if f in filts else -1 for f in run['filterletters']], dtype=int)
+        return lut[run['filterinverse']]
+
+    def getTimeMagFilterBatch(self, ras, decs, filts, doDith=False, version="opsim3_61"):
+        ''' Retrieve timing from the store for a whole array of ra/dec positions in several filters in one pass.
+        Inputs:
+        - ras, decs, doDith, version: as for getTimeMagBatch
+        - filts: a sequence of filter strings
+        Return:
+        - dictionary of (time, m5, offsets) keyed by filter, each as getTimeMagBatch would return for that filter
+        '''
+        filts = _uniqueFilters(filts)
+        setid, fields, setoff = self.getFieldSets(ras, decs, version, doDith)
+        cadences = self.getFieldSetCadences(fields, setoff, filts, version, doDith)
+        return dict([(f, _expandSets(time, m5, off, setid)) for f, (time, m5, off) in cadences.items()])
+
+    def getFieldSets(self, ras, decs, version="opsim3_61", doDith=False):
+        '''
+        Resolve positions to the distinct sets of fields, or of dithered centers, covering them
+        Inputs:
+        ras -- array of RA values in degrees
+        decs -- array of declination values in degrees
+        version -- version of the operation simulator to use
+        doDith -- False for sets of field centers, True for sets of dithered centers
+        Return:
+        setid -- index of the field set of each position, numbered in order of first appearance
+        fields -- sorted field indices of every distinct field set, concatenated
+        setoffsets -- array of nsets+1 offsets; the fields of set k are fields[setoffsets[k]:setoffsets[k+1]]
+        '''
+        ras, decs = _normalize(ras, decs)
+        assert len(ras) == len(decs), "ra and dec arrays must be the same length"
+        index, rows, offsets = self.getCenters(version, doDith)
+        fields, fieldoff = index.queryArray(ras, decs, self.pointing_radius_deg)
+        setid, firsts = _uniqueRows(fields, fieldoff)
+        starts = fieldoff[firsts]
+        stops = fieldoff[firsts + 1]
+        setoffsets = num.zeros(len(firsts) + 1, dtype=int)
+        setoffsets[1:] = num.cumsum(stops - starts)
+        return setid, fields[_raggedRange(starts, stops)], setoffsets
+
+    def getFieldSetCadences(self, fields, setoffsets, filts, version="opsim3_61", doDith=False):
+        '''
+        Compute the cadences of field sets in several filters
+        Inputs:
+        fields, setoffsets -- field sets as returned by getFieldSets
+        filts -- a sequence of filter strings
+        version -- version of the operation simulator to use
+        doDith -- as passed to getFieldSets
+        Return:
+        dictionary of (time, m5, offsets) keyed by filter; the cadence of set k is time[offsets[k]:offsets[k+1]]
+        with the distinct exposures of its fields sorted by time, as getTimeMagSQL returns for a position
+        '''
+        filts = _uniqueFilters(filts)
+        fields = num.asarray(fields, dtype=int)
+        nsets = len(setoffsets) - 1
+        run = self.getRun(version)
+        setid = num.repeat(num.arange(nsets), num.diff(setoffsets))
+        if len(filts) == 1:
+            #Only the exposures of the filter, from its grouping by field
+            rows, offsets = self.getFilterGroups(version, filts[0], doDith)
+            counts = offsets[fields + 1] - offsets[fields]
+            rows = rows[_raggedRange(offsets[fields], offsets[fields + 1])]
+            setid = num.repeat(setid, counts)
+            return {filts[0]: _distinctBatch(setid, run['expMJD'][rows], run['m5'][rows], nsets)}
+        index, rows, offsets = self.getCenters(version, doDith)
+        #The exposures of every field in any filter
+        counts = offsets[fields + 1] - offsets[fields]
+        rows = num.asarray(rows[_raggedRange(offsets[fields], offsets[fields + 1])])
+        setid = num.repeat(setid, counts)
+        codes = self.getFilterCodes(version, filts)[rows]
+        keep = codes >= 0
+        #Group filter major so the cadences of each filter are one contiguous run of groups
+        group = codes[keep]*nsets + setid[keep]
+        rows = rows[keep]
+        time, m5, groupoff = _distinctBatch(group, run['expMJD'][rows], run['m5'][rows], nsets*len(filts))
+        cadences = {}
+        for k, f in enumerate(filts):
+            off = groupoff[k*nsets:(k+1)*nsets + 1]
+            cadences[f] = (time[off[0]:off[-1]], m5[off[0]:off[-1]], off - off[0])
+        return cadences
+
+    def getTimeMagFilterSQL(self, ra, dec, filts, doDith=False, version="opsim3_61"):
+        ''' Retrieve timing from the store for a single ra/dec pair in several filters.  Same contract as
+            DB.getTimeMagFilterSQL.
+        '''
+        cadences = self.getTimeMagFilterBatch([ra], [dec], filts, doDith, version)
+        return dict([(f, (time, m5)) for f, (time, m5, offsets) in cadences.items()])
+
+    def getTimeMagBatch(self, ras, decs, filt, doDith=False, version="opsim3_61"):
+        ''' Retrieve timing from the store for a whole array of ra/dec positions in a particular filter
+            from any of the OpSim runs in one pass.
+        Inputs:
+        - ras: a sequence of RA positions in degrees
+        - decs: a sequence of declination positions in degrees
+        - filt: a string describing the filter for the sampling.  Currently the sloan u, g, r, i, z, and y filters are acceptable values
+        - doDith: boolean to state which pointings to use, the un-dithered (False) or dithered pointings (True)
+        - version: Version of the operation simulator to use.
+        Return:
+        - time: the simulated observations in MJD of all positions, concatenated
+        - m5: the 5 sigma limiting magnitude associated with each observation, concatenated
+        - offsets: array of len(ras)+1 offsets; the cadence of position i is time[offsets[i]:offsets[i+1]]
+        '''
+        #The cadence of each distinct set of covering fields, handed to every position of the set
+        setid, fields, setoff = self.getFieldSets(ras, decs, version, doDith)
+        time, m5, off = self.getFieldSetCadences(fields, setoff, [filt], version, doDith)[filt]
+        return _expandSets(time, m5, off, setid)
+
+    def getTimeMagSQL(self, ra, dec, filt, doDith=False, version="opsim3_61"):
+        ''' Retrieve timing from the store for a single ra/dec pair in a particular filter from
+            any of the OpSim runs.  Same contract as DB.getTimeMagSQL.
+        Inputs:
+        - ra: RA position in degrees
+        - dec: declination position in degrees
+        - filt: a string describing the filter for the sampling.  Currently the sloan u, g, r, i, z, and y filters are acceptable values
+        - doDith: boolean to state which pointings to use, the un-dithered (False) or dithered pointings (True)
+        - version: Version of the operation simulator to use.
+        Return:
+        - time: a sequence of simulated observation in MJD
+        - m5: a sequence of the 5 sigma limiting magnitude associated with each observation
+        '''
+        time, m5, offsets = self.getTimeMagBatch([ra], [dec], filt, doDith, version)
+        return time, m5
@@ -0,0 +1,176 @@
+''' Checkpointed, resumable realization of long lists of positions.
+    A RealizationJob splits its positions into chunks of chunksize and realizes them through
+    LightCurve.iterRealize, one block per chunk, writing the RealizationTable of each chunk to its own
+    file in the job directory as soon as it is realized.  A manifest lists the completed chunks, so a job
+    interrupted at any point, and run again from the same or another process, carries on from the
+    first chunk not completed.  Chunk files and the manifest are written under temporary names and
+    renamed into place, so a file is either complete or absent and rewriting a chunk is harmless.
+    The job directory holds:
+        positions.npy -- (npos, 2) array of the ra, dec of every position
+        manifest.json -- chunk size, parameters of the realization and list of completed chunks
+        chunk_<k>.npz -- RealizationTable of chunk k, see RealizationTable.save
+    With a seed every position draws its noise from the stream of its index in the whole job, so the
+    output of a resumed job is the same as that of an uninterrupted one.  One process should run a
+    job at a time.
+'''
+import os
+import json
+import hashlib
+import tempfile
+import numpy as num
+from RealizationTable import RealizationTable
+
+#Bump when the layout of the job directory changes
+JOB_VERSION = 1
+
+def _writeAtomic(filename, write):
+    #Call write on a temporary file in the directory of filename, then rename it to filename
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), suffix='.tmp')
+    fh = os.fdopen(fd, 'wb')
+    try:
+        write(fh)
+        fh.flush()
+        os.fsync(fh.fileno())
+    finally:
+        fh.close()
+    os.rename(tmpname, filename)
+
+class RealizationJob:
+    ''' Class running a realization in checkpointed chunks '''
+    def __init__(self, directory, ras=None, decs=None, chunksize=10000):
+        '''
+        Create a job in directory, or open the job already there
+        Inputs:
+        directory -- job directory, created if needed
+        ras, decs -- positions in degrees of a new job.  Must be the same positions when given for an
+                     existing job, and may be None to open one.
+        chunksize -- number of positions per chunk of a new job; an existing job keeps its own
+        '''
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        if os.path.exists(self._manifestName()):
+            fh = open(self._manifestName())
+            try:
+                self.manifest = json.load(fh)
+            finally:
+                fh.close()
+            assert self.manifest['version'] == JOB_VERSION, "Job directory written by another version"
+            self.positions = num.load(os.path.join(directory, 'positions.npy'), mmap_mode='r')
+            if ras is not None:
+                if self._hashPositions(self._asPositions(ras, decs)) != self.manifest['positions']:
+                    raise ValueError("Positions differ from those of the job in %s"%(directory))
+        else:
+            assert ras is not None and decs is not None, "A new job needs its positions"
+            positions = self._asPositions(ras, decs)
+            _writeAtomic(os.path.join(directory, 'positions.npy'), lambda fh: num.save(fh, positions))
+            self.positions = positions
+            self.manifest = dict(version=JOB_VERSION, npos=len(positions), chunksize=int(chunksize),
+                                 positions=self._hashPositions(positions), params=None, completed=[])
+            self._writeManifest()
+
+    def _asPositions(self, ras, decs):
+        ras = num.atleast_1d(num.asarray(ras, dtype=float))
+        decs = num.atleast_1d(num.asarray(decs, dtype=float))
+        assert len(ras) == len(decs), "ra and dec arrays must be the same length"
+        return num.column_stack((ras, decs))
+
+    def _hashPositions(self, positions):
+        return hashlib.sha1(num.ascontiguousarray(positions, dtype=float).tostring()).hexdigest()
+
+    def _manifestName(self):
+        return os.path.join(self.directory, 'manifest.json')
+
+    def _writeManifest(self):
+        _writeAtomic(self._manifestName(), lambda fh: json.dump(self.manifest, fh, indent=1, sort_keys=True))
+
+    def getChunkName(self, k):
+        return os.path.join(self.directory, 'chunk_%06d.npz'%(k))
+
+    def getNChunks(self):
+        npos = self.manifest['npos']
+        chunksize = self.manifest['chunksize']
+        return (npos + chunksize - 1)//chunksize
+
+    def getChunkRange(self, k):
+        #Positions [lo, hi) of chunk k
+        chunksize = self.manifest['chunksize']
+        return k*chunksize, min((k + 1)*chunksize, self.manifest['npos'])
+
+    def getCompleted(self):
+        #Sorted list of the completed chunks
+        return sorted(self.manifest['completed'])
+
+    def isComplete(self):
+        return len(self.manifest['completed']) == self.getNChunks()
+
+    def _getParams(self, lightcurve, filtstr, doAddErr, doDith, version, seed):
+        #Parameters fixing the output of the job, checked on resumption
+        filts = [lightcurve.getFilter(ts, filtstr) for ts in lightcurve.tss]
+        return dict(filters=filts, filtstr=filtstr, doAddErr=bool(doAddErr), doDith=bool(doDith),
+                    version=version.lower(), seed=seed)
+
+    def run(self, lightcurve, filtstr=None, doAddErr = False, doDith = False, version="opsim3_61", db = None, workers = 1,
+            threads = 0, seed = None, maxchunks = None):
+        '''
+        Realize the chunks not yet completed, recording each in the manifest once written
+        Inputs:
+        lightcurve -- LightCurve of the models to realize
+        filtstr, doAddErr, doDith, version, db, workers, threads, seed -- as for LightCurve.Realize.  The
+            parameters other than db, workers and threads must be those of any earlier run of the job.
+        maxchunks -- maximum number of chunks to realize in this call, all remaining if None
+        Return:
+        number of chunks realized by this call
+        '''
+        params = self._getParams(lightcurve, filtstr, doAddErr, doDith, version, seed)
+        if self.manifest['params'] is None:
+            self.manifest['params'] = params
+            self._writeManifest()
+        elif self.manifest['params'] != json.loads(json.dumps(params)):
+            raise ValueError("Realization parameters differ from those of the job in %s"%(self.directory))
+        completed = set(self.manifest['completed'])
+        remaining = [k for k in range(self.getNChunks()) if k not in completed]
+        if not remaining:
+            return 0
+        if maxchunks is not None:
+            remaining = remaining[:maxchunks]
+        #Each run of consecutive remaining chunks is realized as one range of positions, so completed
+        #chunks are never realized again
+        runs = []
+        for k in remaining:
+            if runs and runs[-1][-1] == k - 1:
+                runs[-1].append(k)
+            else:
+                runs.append([k])
+        ndone = 0
+        for chunks in runs:
+            lo = self.getChunkRange(chunks[0])[0]
+            hi = self.getChunkRange(chunks[-1])[1]
+            tables = lightcurve.iterRealize(self.positions[lo:hi,0], self.positions[lo:hi,1], filtstr, doAddErr, doDith,
+                                            version, db, workers, threads, self.manifest['chunksize'], columnar = True,
+                                            seed = seed, start = lo)
+            try:
+                for n, table in enumerate(tables):
+                    k = chunks[n]
+                    _writeAtomic(self.getChunkName(k), table.save)
+                    completed.add(k)
+                    self.manifest['completed'] = sorted(completed)
+                    self._writeManifest()
+                    ndone += 1
+            finally:
+                tables.close()
+        return ndone
+
+    def getTable(self, k):
+        ''' Return the RealizationTable of completed chunk k '''
+        assert k in self.manifest['completed'], "Chunk %d is not completed"%(k)
+        return RealizationTable.load(self.getChunkName(k))
+
+    def iterTables(self):
+        ''' Yield the RealizationTable of each completed chunk in order '''
+        for k in self.getCompleted():
+            yield self.getTable(k)
+
+    def getRealizationTable(self):
+        ''' Return the realizations of all completed chunks as one RealizationTable '''
+        return RealizationTable.concatenate(self.iterTables())
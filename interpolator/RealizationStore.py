@@ -0,0 +1,196 @@
+''' Appendable, memory mapped on disk store of realizations.
+    A store is a directory holding one raw binary file per column, in the layout of RealizationTable:
+    time, mag, magerrbright, magerrdim and m5 (float64), pos (int64 position id), model (int32) and
+    filt (int8 index into FILTERS), with one row per realized epoch.  Rows are grouped by position, then
+    model, and offsets.bin (int64) delimits each group, so the rows of model j at position i are
+    offsets[i*nmodels + j] to offsets[i*nmodels + j + 1] and any light curve is found in O(1).  ras.bin
+    and decs.bin hold the position of each position id.  meta.json records the filter of each model and
+    the numbers of positions and rows.
+    append adds the positions of a RealizationTable (or a list of LightCurve objects) after those
+    already stored, writing the columns first and meta.json last by an atomic rename, so readers and a
+    store reopened after an interrupted append only ever see whole positions; data written past the
+    recorded counts is cut off by the next append.  Readers memory map the columns and
+    getColumns, getTimeSeries, getLightCurve and getTable return views of the maps without copying.
+    The tables of a RealizationJob may be gathered into one store by appending job.iterTables().
+'''
+import os
+import json
+import tempfile
+import numpy as num
+from RealizationTable import RealizationTable
+
+#Bump when the layout of the store changes
+STORE_VERSION = 1
+
+#Row columns and their types, in the order of RealizationTable.columns followed by the ids
+_rowTypes = [('time', num.float64), ('mag', num.float64), ('magerrbright', num.float64), ('magerrdim', num.float64),
+             ('m5', num.float64), ('pos', num.int64), ('model', num.int32), ('filt', num.int8)]
+#Position columns and their types
+_posTypes = [('ras', num.float64), ('decs', num.float64)]
+
+class RealizationStore:
+    ''' Class for appending realizations to, and reading them from, a directory of memory mapped columns '''
+    def __init__(self, directory, filters=None, mode='r'):
+        '''
+        Open a store
+        Inputs:
+        directory -- directory of the store
+        filters -- filter string of each model; required to create a store, checked against an existing one
+        mode -- 'r' to read an existing store, 'a' to append to it, creating it if missing
+        '''
+        assert mode in ('r', 'a'), "mode must be r or a"
+        self.directory = directory
+        self.mode = mode
+        self._maps = {}
+        self._mapped = None
+        if not os.path.exists(self._metaName()):
+            assert mode == 'a', "No store in %s"%(directory)
+            assert filters is not None, "Creating a store needs the filter of each model"
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            for name, dtype in _rowTypes + _posTypes + [('offsets', num.int64)]:
+                open(self._columnName(name), 'wb').close()
+            self.meta = dict(version=STORE_VERSION, filters=list(filters), npos=0, nrows=0)
+            #The offset of the first group
+            self._appendColumn('offsets', num.zeros(1, dtype=num.int64), 0)
+            self._writeMeta()
+        self.meta = self._readMeta()
+        assert self.meta['version'] == STORE_VERSION, "Store written by another version"
+        self.filters = [str(f) for f in self.meta['filters']]
+        self.nmodels = len(self.filters)
+        if filters is not None and list(filters) != self.filters:
+            raise ValueError("Filters differ from those of the store in %s"%(directory))
+
+    def _metaName(self):
+        return os.path.join(self.directory, 'meta.json')
+
+    def _columnName(self, name):
+        return os.path.join(self.directory, name + '.bin')
+
+    def _readMeta(self):
+        fh = open(self._metaName())
+        try:
+            return json.load(fh)
+        finally:
+            fh.close()
+
+    def _writeMeta(self):
+        #Written under a temporary name and renamed so readers never see a partial file
+        fd, tmpname = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        fh = os.fdopen(fd, 'w')
+        try:
+            json.dump(self.meta, fh, indent=1, sort_keys=True)
+            fh.flush()
+            os.fsync(fh.fileno())
+        finally:
+            fh.close()
+        os.rename(tmpname, self._metaName())
+
+    def _appendColumn(self, name, values, count):
+        #Write values after the first count elements of a column, cutting off anything beyond them
+        values = num.ascontiguousarray(values)
+        fh = open(self._columnName(name), 'r+b')
+        try:
+            fh.seek(count*values.dtype.itemsize)
+            fh.truncate()
+            fh.write(values.tostring())
+            fh.flush()
+            os.fsync(fh.fileno())
+        finally:
+            fh.close()
+
+    def __len__(self):
+        #Number of positions
+        return self.meta['npos']
+
+    def getNRows(self):
+        #Total number of realized epochs
+        return self.meta['nrows']
+
+    def refresh(self):
+        ''' Reread the counts, to see positions appended by another process since the store was opened '''
+        self.meta = self._readMeta()
+
+    def append(self, table):
+        '''
+        Append realizations after those in the store
+        Inputs:
+        table -- RealizationTable, or list of LightCurve objects as returned by Realize, of the models of the store
+        Return:
+        position id of the first appended position
+        '''
+        assert self.mode == 'a', "Store opened read only"
+        if not isinstance(table, RealizationTable):
+            table = RealizationTable.fromLightCurves(table, self.filters)
+        if table.filters != self.filters:
+            raise ValueError("Table filters differ from those of the store in %s"%(self.directory))
+        npos = self.meta['npos']
+        nrows = self.meta['nrows']
+        columns = dict([(name, getattr(table, name)) for name in RealizationTable.columns])
+        columns['pos'] = table.pos + npos
+        columns['model'] = table.model
+        columns['filt'] = table.filt
+        for name, dtype in _rowTypes:
+            self._appendColumn(name, num.asarray(columns[name], dtype=dtype), nrows)
+        for name, dtype in _posTypes:
+            self._appendColumn(name, num.asarray(getattr(table, name), dtype=dtype), npos)
+        #Offsets after the first, shifted past the rows already stored
+        self._appendColumn('offsets', table.offsets[1:] + nrows, npos*self.nmodels + 1)
+        self.meta['npos'] = npos + len(table)
+        self.meta['nrows'] = nrows + table.getNRows()
+        self._writeMeta()
+        return npos
+
+    def _map(self, name):
+        #Memory map of a column over the recorded counts, remapped when the counts change
+        counts = (self.meta['npos'], self.meta['nrows'])
+        if self._mapped != counts:
+            self._maps = {}
+            self._mapped = counts
+        if name not in self._maps:
+            dtype = dict(_rowTypes + _posTypes + [('offsets', num.int64)])[name]
+            if name == 'offsets':
+                count = counts[0]*self.nmodels + 1
+            elif name in ('ras', 'decs'):
+                count = counts[0]
+            else:
+                count = counts[1]
+            if count == 0:
+                self._maps[name] = num.zeros(0, dtype=dtype)
+            else:
+                self._maps[name] = num.memmap(self._columnName(name), dtype=dtype, mode='r', shape=(count,))
+        return self._maps[name]
+
+    def getColumn(self, name):
+        #Memory mapped column of all rows (or of all positions for ras, decs and offsets)
+        return self._map(name)
+
+    def getRange(self, pos, model):
+        #Row range [lo, hi) of the realization of model at position id pos
+        assert 0 <= pos < len(self) and 0 <= model < self.nmodels, "No realization (%d, %d) in the store"%(pos, model)
+        offsets = self._map('offsets')
+        k = pos*self.nmodels + model
+        return int(offsets[k]), int(offsets[k+1])
+
+    def getColumns(self, pos, model):
+        #Dictionary of views of the columns for the realization of model at position id pos
+        lo, hi = self.getRange(pos, model)
+        return dict([(name, self._map(name)[lo:hi]) for name in RealizationTable.columns])
+
+    def getTable(self, lo=0, hi=None):
+        ''' Return the positions [lo, hi) as a RealizationTable whose columns are views of the maps '''
+        if hi is None:
+            hi = len(self)
+        offsets = self._map('offsets')[lo*self.nmodels:hi*self.nmodels + 1]
+        rlo, rhi = int(offsets[0]), int(offsets[-1])
+        cols = [self._map(name)[rlo:rhi] for name in RealizationTable.columns]
+        return RealizationTable(self._map('ras')[lo:hi], self._map('decs')[lo:hi], self.filters,
+                                num.asarray(offsets) - rlo, *cols)
+
+    def getTimeSeries(self, pos, model):
+        #Realization of model at position id pos as a TimeSeriesMag holding views of the maps
+        return self.getTable(pos, pos + 1).getTimeSeries(0, model)
+
+    def getLightCurve(self, pos, isperiodic=None):
+        #Realizations at position id pos as a LightCurve, as Realize returns them
+        return self.getTable(pos, pos + 1).getLightCurve(0, isperiodic)
@@ -0,0 +1,160 @@
+''' Columnar container for the realizations of a set of models at a set of positions.
+    Every realized epoch of every (position, model) pair is a row of one contiguous array per column:
+    time, mag, magerrbright, magerrdim and m5, with the integer columns pos, model and filt (index into
+    FILTERS) identifying its realization.  Rows are grouped by position, then model, and
+    offsets[pos*nmodels + model] delimits each group, so whole-run analysis may be vectorized over the
+    columns while getTimeSeries and getLightCurve present any realization through the TimeSeriesMag
+    and LightCurve interfaces as views of the columns, without copying.
+    save and load write and read a table as one .npz file.
+'''
+import numpy as num
+from MagUtils import MagUtils, FILTERS, filterIndex
+from TimeSeriesMag import TimeSeriesMag
+
+class RealizationTable:
+    ''' Class holding realizations as a struct of arrays '''
+    columns = ['time', 'mag', 'magerrbright', 'magerrdim', 'm5']
+    def __init__(self, ras, decs, filters, offsets, time, mag, magerrbright, magerrdim, m5):
+        '''
+        Construct a RealizationTable from its columns
+        Inputs:
+        ras -- RA in degrees of each position
+        decs -- Declination in degrees of each position
+        filters -- filter string of each model
+        offsets -- array of len(ras)*len(filters)+1 offsets; the rows of model j at position i
+                   are offsets[i*len(filters) + j] to offsets[i*len(filters) + j + 1]
+        time, mag, magerrbright, magerrdim, m5 -- column arrays of all realized epochs
+        '''
+        self.ras = num.asarray(ras, dtype=float)
+        self.decs = num.asarray(decs, dtype=float)
+        self.filters = list(filters)
+        self.nmodels = len(self.filters)
+        self.offsets = num.asarray(offsets, dtype=num.int64)
+        assert len(self.offsets) == len(self.ras)*self.nmodels + 1, "offsets must delimit every (position, model) pair"
+        self.time = num.asarray(time, dtype=float)
+        self.mag = num.asarray(mag, dtype=float)
+        self.magerrbright = num.asarray(magerrbright, dtype=float)
+        self.magerrdim = num.asarray(magerrdim, dtype=float)
+        self.m5 = num.asarray(m5, dtype=float)
+        #Integer columns identifying the realization of each row
+        counts = num.diff(self.offsets)
+        pair = num.repeat(num.arange(len(counts)), counts)
+        self.pos = pair//max(self.nmodels, 1)
+        self.model = pair%max(self.nmodels, 1)
+        filtidx = filterIndex(self.filters)
+        self.filt = filtidx[self.model] if self.nmodels else num.zeros(0, dtype=num.int8)
+
+    def __len__(self):
+        #Number of positions
+        return len(self.ras)
+
+    def getNRows(self):
+        #Total number of realized epochs
+        return len(self.time)
+
+    def getFlux(self, out=None):
+        #Fluxes of all rows, converted from the mag column in one call over the filt column
+        return MagUtils().toFluxIdx(self.mag, self.filt, out=out)
+
+    def getRange(self, pos, model):
+        #Row range [lo, hi) of the realization of model at position pos
+        k = pos*self.nmodels + model
+        return int(self.offsets[k]), int(self.offsets[k+1])
+
+    def getColumns(self, pos, model):
+        #Dictionary of views of the columns for the realization of model at position pos
+        lo, hi = self.getRange(pos, model)
+        return dict([(name, getattr(self, name)[lo:hi]) for name in self.columns])
+
+    def getTimeSeries(self, pos, model):
+        '''
+        Return the realization of model at position pos as a TimeSeriesMag holding views of the columns.
+        Like Realize, a realization with no epochs has None arrays.
+        '''
+        lo, hi = self.getRange(pos, model)
+        ra = self.ras[pos]
+        dec = self.decs[pos]
+        fs = self.filters[model]
+        if hi == lo:
+            return TimeSeriesMag(None, None, None, None, fs, calcspline = False, ra = ra, dec = dec)
+        return TimeSeriesMag(self.time[lo:hi], self.mag[lo:hi], self.magerrbright[lo:hi], self.magerrdim[lo:hi], fs,
+                             calcspline = False, ra = ra, dec = dec, m5 = self.m5[lo:hi])
+
+    def getLightCurve(self, pos, isperiodic=None):
+        #Return the realizations at position pos as a LightCurve, as Realize does
+        from LightCurve import LightCurve
+        return LightCurve([self.getTimeSeries(pos, j) for j in range(self.nmodels)], isperiodic)
+
+    def getLightCurves(self, isperiodic=None):
+        #Return the list of LightCurve objects of all positions, as Realize does
+        return [self.getLightCurve(i, isperiodic) for i in range(len(self))]
+
+    def save(self, filename):
+        ''' Write the table to filename (or an open file) as an .npz file, see load '''
+        arrays = dict([(name, getattr(self, name)) for name in self.columns])
+        num.savez(filename, ras=self.ras, decs=self.decs, filters=num.array(self.filters, dtype='S'),
+                  offsets=self.offsets, **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        ''' Read a table written by save '''
+        npz = num.load(filename)
+        try:
+            filters = [str(f) for f in npz['filters']]
+            return cls(npz['ras'], npz['decs'], filters, npz['offsets'], *[npz[name] for name in cls.columns])
+        finally:
+            npz.close()
+
+    @classmethod
+    def concatenate(cls, tables):
+        ''' Concatenate tables of the same models at different positions into one table '''
+        tables = list(tables)
+        assert len(tables) > 0, "At least one table is needed"
+        filters = tables[0].filters
+        for t in tables:
+            assert t.filters == filters, "Tables must realize the same models"
+        offsets = [num.zeros(1, dtype=num.int64)]
+        start = 0
+        for t in tables:
+            offsets.append(t.offsets[1:] + start)
+            start += t.getNRows()
+        cols = [num.concatenate([getattr(t, name) for t in tables]) for name in cls.columns]
+        return cls(num.concatenate([t.ras for t in tables]), num.concatenate([t.decs for t in tables]), filters,
+                   num.concatenate(offsets), *cols)
+
+    @classmethod
+    def fromLightCurves(cls, lcs, filters=None):
+        '''
+        Build a table from a list of LightCurve objects as returned by Realize
+        Inputs:
+        lcs -- list of LightCurve objects, one per position, each with one TimeSeriesMag per model
+        filters -- filter of each model; taken from the first LightCurve if None
+        '''
+        if filters is None:
+            filters = [ts.getFilter() for ts in lcs[0].tss]
+        ras = [lc.tss[0]._ra for lc in lcs]
+        decs = [lc.tss[0]._dec for lc in lcs]
+        cols = dict([(name, []) for name in cls.columns])
+        counts = []
+        for lc in lcs:
+            for ts in lc.tss:
+                time = num.atleast_1d(ts.getTime())
+                if time.dtype == object:
+                    #Realization with no epochs
+                    counts.append(0)
+                    continue
+                counts.append(len(time))
+                cols['time'].append(time)
+                cols['mag'].append(ts.getMag())
+                cols['magerrbright'].append(ts.getMagErrBright())
+                cols['magerrdim'].append(ts.getMagErrDim())
+                cols['m5'].append(ts.getM5())
+        offsets = num.zeros(len(counts) + 1, dtype=num.int64)
+        offsets[1:] = num.cumsum(counts)
+        arrays = []
+        for name in cls.columns:
+            if cols[name]:
+                arrays.append(num.concatenate(cols[name]))
+            else:
+                arrays.append(num.zeros(0))
+        return cls(ras, decs, filters, offsets, *arrays)
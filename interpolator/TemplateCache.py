@@ -0,0 +1,162 @@
+''' Binary cache of parsed light curve template files.
+    compileTemplate turns a whitespace text template into <filename>.npz holding the sample columns,
+    the header, and the knots and coefficients of the interpolating splines of the u, g, r, i, z, y
+    columns.  loadTemplate reads the compiled file in place of the text whenever it is fresh, that is
+    written by this CACHE_VERSION from a source of the same modification time and size, and parses
+    the text otherwise.  Compile a template set once with
+        python TemplateCache.py template1.txt template2.txt ...
+    so that worker processes skip the text parsing and spline fitting on start-up.
+    readHeader and parseHeader read the "# Key : value" header lines by key rather than by position.
+'''
+import os
+import sys
+import tempfile
+import numpy as num
+from MagUtils import FILTERS
+from Interpolate import MultiBandSpline
+
+#Bump when the layout of the compiled files changes so that older files are ignored
+CACHE_VERSION = 1
+
+def readHeader(filename):
+    ''' Read the "# Key : value" header lines of a template file
+    Inputs:
+    filename -- template file
+    Return:
+    dictionary of the header values keyed by lower case key; empty if the file has no header
+    '''
+    header = {}
+    fh = open(filename)
+    for line in fh:
+        if not line.startswith('#'):
+            break
+        if ':' not in line:
+            continue
+        key, value = line[1:].split(':', 1)
+        header[key.strip().lower()] = value.strip().strip('"')
+    fh.close()
+    return header
+
+def parseHeader(header):
+    '''
+    Interpret the header of a template
+    Inputs:
+    header -- dictionary returned by readHeader
+    Return:
+    dictionary with isPeriodic (True only if the IsPeriodic value reads True), period (periodic) or
+    lifetime (non periodic) in days from the Period or Lifetime value, and normalization and spectrum
+    if given.  Values missing from the header are missing from the dictionary.
+    '''
+    params = {}
+    if header.has_key('isperiodic'):
+        params['isPeriodic'] = header['isperiodic'].split()[0].lower() == 'true'
+    for key in ['period', 'lifetime']:
+        if header.has_key(key):
+            length = float(header[key].split()[0])
+            if params.get('isPeriodic', key == 'period'):
+                params['period'] = length
+            else:
+                params['lifetime'] = length
+    for key in ['normalization', 'spectrum']:
+        if header.has_key(key):
+            params[key] = header[key]
+    return params
+
+def compiledName(filename):
+    ''' Name of the compiled file of a template '''
+    return filename + '.npz'
+
+class Template:
+    ''' Class holding a parsed template: columns, header and, if available, spline coefficients '''
+    def __init__(self, filename, data, header, tck=None):
+        '''
+        Inputs:
+        filename -- template file
+        data -- (ncolumns, npoints) array of the columns, as numpy.loadtxt(unpack=True)
+        header -- dictionary returned by readHeader
+        tck -- (knots, coefficients, degree) of the interpolating splines of the FILTERS columns,
+               coefficients being (ncoefficients, len(FILTERS)); None if not fitted
+        '''
+        self.filename = filename
+        self.data = data
+        self.header = header
+        self.params = parseHeader(header)
+        self.tck = tck
+
+    def getMultiBandSpline(self, magOff=0.):
+        ''' Return the MultiBandSpline of the FILTERS columns plus magOff, from the coefficients if available '''
+        if self.tck is None:
+            return MultiBandSpline(self.data[0], self.data[1:len(FILTERS)+1].T + magOff)
+        t, c, k = self.tck
+        return MultiBandSpline.fromTck(t, c + magOff, k)
+
+def _fitTck(data):
+    #Knots and coefficients of the interpolating splines of the FILTERS columns, if the template has them
+    if data.shape[0] < len(FILTERS) + 1 or data.shape[1] < 4 or not (num.diff(data[0]) > 0).all():
+        return None
+    return MultiBandSpline(data[0], data[1:len(FILTERS)+1].T).getTck()
+
+def _isFresh(filename, compiled):
+    stat = os.stat(filename)
+    return (int(compiled['version']) == CACHE_VERSION and float(compiled['mtime']) == stat.st_mtime
+            and int(compiled['size']) == stat.st_size)
+
+def compileTemplate(filename, outfile=None):
+    '''
+    Compile a template into a binary file read by loadTemplate
+    Inputs:
+    filename -- text template file
+    outfile -- compiled file to write, compiledName(filename) if None
+    Return:
+    name of the compiled file
+    '''
+    if outfile is None:
+        outfile = compiledName(filename)
+    stat = os.stat(filename)
+    data = num.loadtxt(filename, unpack=True, comments='#', ndmin=2)
+    header = readHeader(filename)
+    tck = _fitTck(data)
+    arrays = dict(version=CACHE_VERSION, mtime=stat.st_mtime, size=stat.st_size, data=data,
+                  headerkeys=num.array(header.keys(), dtype='S'), headervalues=num.array(header.values(), dtype='S'))
+    if tck is not None:
+        arrays['knots'], arrays['coeffs'], arrays['degree'] = tck
+    #Written under a temporary name and renamed so readers never see a partial file
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(outfile)), suffix='.npz')
+    fh = os.fdopen(fd, 'wb')
+    try:
+        num.savez(fh, **arrays)
+    finally:
+        fh.close()
+    os.rename(tmpname, outfile)
+    return outfile
+
+def loadTemplate(filename):
+    '''
+    Load a template, from its compiled file if that is fresh, else by parsing the text
+    Inputs:
+    filename -- text template file
+    Return:
+    Template object
+    '''
+    compiled = compiledName(filename)
+    if os.path.exists(compiled):
+        try:
+            npz = num.load(compiled)
+            try:
+                if _isFresh(filename, npz):
+                    header = dict(zip([str(k) for k in npz['headerkeys']], [str(v) for v in npz['headervalues']]))
+                    tck = None
+                    if 'knots' in npz.files:
+                        tck = (npz['knots'], npz['coeffs'], int(npz['degree']))
+                    return Template(filename, npz['data'], header, tck)
+            finally:
+                npz.close()
+        except (IOError, KeyError, ValueError):
+            #Unreadable compiled file; fall back to the text
+            pass
+    data = num.loadtxt(filename, unpack=True, comments='#', ndmin=2)
+    return Template(filename, data, readHeader(filename))
+
+if __name__ == '__main__':
+    for filename in sys.argv[1:]:
+        print compileTemplate(filename)
@@ -0,0 +1,249 @@
+''' Library of light curve templates packed into one array for population runs.
+    Templates are read from files in the sampleRRly.txt header format (Period, IsPeriodic and
+    Normalization lines followed by a phase column and u, g, r, i, z, y magnitude columns), from
+    headerless files such as periodic.dat or sn1a_lc.v1.1.dat given a column map, or from arrays.
+    Files are read through TemplateCache, so compiled templates are used when fresh.
+    Each template is resampled by a spline onto a common grid of nphase intervals spanning one period
+    (periodic templates) or its lifetime (non periodic templates) and packed into a contiguous
+    (n_templates, nphase+1, n_filters) array of magnitudes, with a metadata record array holding the
+    period, periodicity, window, normalization and resampling deviation of each template.
+    evaluate gives the magnitudes of any subset of templates at arbitrary epochs by one vectorized
+    lookup, and getModels returns LibraryTemplate objects which LightCurve.Realize evaluates together.
+'''
+import os
+import glob
+import numpy as num
+from MagUtils import MagUtils, FILTERS
+from Interpolate import MultiBandSpline
+from TemplateCache import loadTemplate
+
+#Metadata of each template
+metaDtype = [('name', 'S64'), ('isPeriodic', bool), ('period', float), ('start', float), ('duration', float),
+             ('normalization', 'S32'), ('maxDeviation', float)]
+
+class TemplateLibrary:
+    ''' Class packing many light curve templates onto a common grid '''
+    def __init__(self, nphase=1000, filters=FILTERS):
+        '''
+        Construct an empty library
+        Inputs:
+        nphase -- number of grid intervals over the period or lifetime of each template
+        filters -- filters held for each template; a template without one of them gives nan in it
+        '''
+        self.nphase = nphase
+        self.filters = list(filters)
+        self._grids = []
+        self._meta = []
+        self._packed = None
+        self._noflux = num.array([MagUtils().toMag(0., f) for f in self.filters])
+
+    def __len__(self):
+        return len(self._meta)
+
+    def add(self, x, mags, period=None, isPeriodic=None, name='', normalization='', filters=None, spline=None):
+        '''
+        Add a template sampled at points x
+        Inputs:
+        x -- phase in [0, 1] of each point for a periodic template, or time in days for a non periodic one
+        mags -- (len(x), len(filters)) array of magnitudes
+        period -- period in days of a periodic template
+        isPeriodic -- True if the template is periodic; if None, periodic when a period is given
+        name, normalization -- metadata of the template
+        filters -- filter of each column of mags, those of the library if None
+        spline -- MultiBandSpline through all columns of mags, fitted if None
+        Return:
+        index of the template in the library
+        '''
+        if filters is None:
+            filters = self.filters
+        if isPeriodic is None:
+            isPeriodic = period is not None
+        x = num.asarray(x, dtype=float)
+        mags = num.asarray(mags, dtype=float).reshape(len(x), len(filters))
+        if isPeriodic:
+            assert period is not None and period > 0, "A periodic template needs a positive period"
+            start, duration = 0., float(period)
+            nodes = num.arange(self.nphase + 1)/float(self.nphase)
+        else:
+            start, duration = x[0], x[-1] - x[0]
+            period = num.nan
+            nodes = start + duration*num.arange(self.nphase + 1)/float(self.nphase)
+        #Resample the bands held by the library onto the grid
+        columns = [filters.index(f) for f in self.filters if f in filters]
+        grid = num.empty((self.nphase + 1, len(self.filters)))
+        grid.fill(num.nan)
+        bands = [self.filters.index(f) for f in self.filters if f in filters]
+        maxdev = 0.
+        if columns:
+            if spline is None:
+                spline = MultiBandSpline(x, mags)
+            grid[:,bands] = spline(nodes)[:,columns]
+            #Deviation of the linear interpolation of the grid from the spline, largest at mid intervals
+            mids = 0.5*(nodes[1:] + nodes[:-1])
+            maxdev = num.abs(0.5*(grid[1:,bands] + grid[:-1,bands]) - spline(mids)[:,columns]).max()
+        self._grids.append(grid)
+        self._meta.append((name[:64], bool(isPeriodic), period, start, duration, normalization[:32], maxdev))
+        self._packed = None
+        return len(self._meta) - 1
+
+    def addFile(self, filename, columns=None, period=None, isPeriodic=None, fluxZeroPoint=None):
+        '''
+        Add a template from a file
+        Inputs:
+        filename -- template file; a sampleRRly.txt style header supplies the period, periodicity and
+                    normalization, and the u, g, r, i, z, y magnitudes are read from columns 1 to 6
+        columns -- dictionary of the column index keyed by filter, for files in other layouts
+        period, isPeriodic -- override or, for headerless files, supply the header values
+        fluxZeroPoint -- if given, the columns hold fluxes, converted to -2.5 log10(flux) + fluxZeroPoint
+        Return:
+        index of the template in the library
+        '''
+        template = loadTemplate(filename)
+        data = template.data.T
+        spline = None
+        if columns is None:
+            columns = dict([(f, i + 1) for i, f in enumerate(FILTERS) if i + 1 < data.shape[1]])
+            if fluxZeroPoint is None and template.tck is not None:
+                #Compiled coefficients of the u, g, r, i, z, y columns
+                spline = template.getMultiBandSpline()
+        filters = [f for f in FILTERS if f in columns] + [f for f in columns if f not in FILTERS]
+        mags = data[:,[columns[f] for f in filters]]
+        if fluxZeroPoint is not None:
+            mags = -2.5*num.log10(mags) + fluxZeroPoint
+        params = template.params
+        if isPeriodic is None and params.has_key('isPeriodic'):
+            isPeriodic = params['isPeriodic']
+        if period is None and params.has_key('period') and (isPeriodic or isPeriodic is None):
+            period = params['period']
+        return self.add(data[:,0], mags, period, isPeriodic, os.path.basename(filename),
+                        params.get('normalization', ''), filters, spline)
+
+    @classmethod
+    def fromFiles(cls, files, nphase=1000, filters=FILTERS, **kwargs):
+        '''
+        Build a library from template files
+        Inputs:
+        files -- a directory, whose files are all read, or a list of files
+        nphase, filters -- as for the constructor
+        kwargs -- passed to addFile for every file
+        '''
+        if isinstance(files, basestring) and os.path.isdir(files):
+            files = sorted([f for f in glob.glob(os.path.join(files, '*')) if os.path.isfile(f)])
+        library = cls(nphase, filters)
+        for filename in files:
+            library.addFile(filename, **kwargs)
+        return library
+
+    def pack(self):
+        ''' Return the packed (n_templates, nphase+1, n_filters) magnitudes and the metadata record array '''
+        if self._packed is None:
+            mags = num.empty((len(self._grids), self.nphase + 1, len(self.filters)))
+            for i, grid in enumerate(self._grids):
+                mags[i] = grid
+            #The packed array replaces the per template grids
+            self._grids = list(mags)
+            self._packed = (mags, num.array(self._meta, dtype=metaDtype))
+        return self._packed
+
+    def getMags(self):
+        return self.pack()[0]
+
+    def getMeta(self):
+        return self.pack()[1]
+
+    def evaluate(self, epochs, templates=None, filt=None, t0=0., magOff=0., inside=False):
+        '''
+        Evaluate templates at epochs by linear interpolation in the grid
+        Inputs:
+        epochs -- array of epochs in days shared by all templates, or an (n, n_epochs) array with the
+                  epochs of each template
+        templates -- indices of the n templates to evaluate, all of them if None
+        filt -- filter to evaluate, all filters of the library if None
+        t0 -- epoch of phase 0 (periodic) or of time 0 (non periodic) of each template, broadcast to n
+        magOff -- magnitude offset of each template, broadcast to n
+        inside -- True to also return the mask of the epochs inside the window of each template
+        Return:
+        (n, n_epochs) array of magnitudes, or (n, n_epochs, n_filters) if filt is None; non periodic
+        templates have the magnitude of zero flux outside their window.  Also the (n, n_epochs) mask
+        if inside is True.
+        '''
+        mags, meta = self.pack()
+        if templates is None:
+            templates = num.arange(len(meta))
+        templates = num.atleast_1d(num.asarray(templates, dtype=int))
+        n = len(templates)
+        t0 = num.resize(num.asarray(t0, dtype=float), n)
+        magOff = num.resize(num.asarray(magOff, dtype=float), n)
+        meta = meta[templates]
+        #Fraction of the period, or of the lifetime, at each epoch
+        u = num.asarray(epochs, dtype=float) - t0[:,None]
+        u -= meta['start'][:,None]
+        u /= meta['duration'][:,None]
+        periodic = num.broadcast_to(meta['isPeriodic'][:,None], u.shape)
+        num.remainder(u, 1., out=u, where=periodic)
+        mask = periodic | ((u >= 0.) & (u <= 1.))
+        pos = u*self.nphase
+        num.clip(pos, 0., self.nphase, out=pos)
+        idx = pos.astype(num.intp)
+        num.minimum(idx, self.nphase - 1, out=idx)
+        frac = pos - idx
+        rows = templates[:,None]
+        if filt is None:
+            y0 = mags[rows, idx]
+            y1 = mags[rows, idx + 1]
+            frac = frac[..., None]
+            values = y0 + frac*(y1 - y0)
+            values += magOff[:,None,None]
+            values[~mask] = self._noflux
+        else:
+            band = self.filters.index(filt)
+            y0 = mags[rows, idx, band]
+            y1 = mags[rows, idx + 1, band]
+            values = y0 + frac*(y1 - y0)
+            values += magOff[:,None]
+            values[~mask] = self._noflux[band]
+        if inside:
+            return values, mask
+        return values
+
+    def getModels(self, templates=None, t0=0., magOff=0.):
+        '''
+        Return a list of LibraryTemplate objects, one per template, to pass to LightCurve as models
+        Inputs:
+        templates, t0, magOff -- as for evaluate
+        '''
+        if templates is None:
+            templates = num.arange(len(self))
+        templates = num.atleast_1d(num.asarray(templates, dtype=int))
+        t0 = num.resize(num.asarray(t0, dtype=float), len(templates))
+        magOff = num.resize(num.asarray(magOff, dtype=float), len(templates))
+        return [LibraryTemplate(self, i, t, m) for i, t, m in zip(templates, t0, magOff)]
+
+class LibraryTemplate:
+    ''' One template of a TemplateLibrary at an epoch and magnitude offset, for use as a model of LightCurve.
+        Like interpolateGenerator it holds all filters of the template, so Realize needs a filtstr.
+    '''
+    def __init__(self, library, index, t0=0., magOff=0.):
+        self.library = library
+        self.index = index
+        self.t0 = t0
+        self.magOff = magOff
+
+    def evaluate(self, epochs, filt=None):
+        return self.library.evaluate(epochs, [self.index], filt, self.t0, self.magOff)[0]
+
+    def getWindow(self):
+        #Interval of epochs outside of which a non periodic template has no flux, None if periodic
+        meta = self.library.getMeta()[self.index]
+        if meta['isPeriodic']:
+            return None
+        return (self.t0 + meta['start'], self.t0 + meta['start'] + meta['duration'])
+
+    def getFamilyKey(self):
+        #Templates of one library are evaluated together by evaluateFamily
+        return ('library', id(self.library))
+
+    def evaluateFamily(self, members, dates, filt):
+        ''' Evaluate templates of the same library at dates; returns the magnitudes and the inside mask '''
+        return self.library.evaluate(dates, [m.index for m in members], filt, [m.t0 for m in members],
+                                     [m.magOff for m in members], inside=True)
@@ -3,16 +3,38 @@
     magnitude error valerr, a filter descriptor filterstr, a boolean which
     determines whether to calculate a spline for the time series calcspline,
     and a period for the time series in days period.  If the period argument
-    is negative, the time series is assumed to be non periodic
+    is negative (or None), the time series is assumed to be non periodic and has
+    no flux outside the window spanned by its time points, see getWindow
+    shift and expand make copies of a template at other offsets and magnitude shifts
+    which share its spline, and evaluateMany evaluates a template at many offsets and
+    magnitude shifts against one set of dates in a single broadcast computation.
+    Splines are fit through makespline, so a SplineCache set by Interpolate.setSplineCache spares the
+    fit of time series seen before, and are pickled as their knots, coefficients and degree.
+    TimeSeriesMag objects hold their attributes in __slots__ and keep the arrays they are given without
+    copying, so the realizations of several models at one position share its cadence arrays.
     Modified:
     Jan 2008 by K. Simon Krughoff krughoff@astro.washington.edu
     March 2011 by K. Simon Krughoff for TVS group
 '''
-from Interpolate import makespline, evalper
+from Interpolate import makespline, evalper, evalnonper, TabulatedSpline, SplineTck, splineToTck
 from MagUtils import MagUtils
+import weakref
 import numpy as num
 from warnings import warn
-class TimeSeriesMag:
+
+#MagUtils holds no state, so one instance serves every time series
+_mutils = MagUtils()
+
+#SplineTck of each scipy spline pickled, so time series sharing a spline still share it once unpickled
+_pickledSplines = weakref.WeakKeyDictionary()
+
+#Read only stand in shared by the arrays of every time series constructed from None
+_noneArray = num.asarray(None)
+_noneArray.flags.writeable = False
+
+class TimeSeriesMag(object):
+    __slots__ = ('_time', '_mag', '_magerrbright', '_magerrdim', '_m5s', '_ra', '_dec', '_filter',
+                 '_spline', '_period', '_offset', '_magshift')
     def __init__(self, time, values, valerrp, valerrm, filterstr, calcspline=True, period=None, offset = 0, ra=None, dec=None, m5=None):
         ''' Construct TimeSeriesMag object from time sampling time, magnitude values values
             magnitude error values valerr, filter designation filterstr, whether to calculate
@@ -35,14 +57,14 @@ class TimeSeriesMag:
         self.getParams(time, values, valerrp, valerrm, m5, filterstr, calcspline, period, offset, ra, dec)
 
     def getParams(self, time, values, valerrp, valerrm, m5, filterstr, calcspline, period, offset, ra, dec):
-        #Set time series arrays and meta data for a time series
+        #Set time series arrays and meta data for a time series.  Arrays are kept as given, not copied.
         #Magnitude values
-        values = num.asarray(values)
+        values = self._asArray(values)
         #Time sampling for the time series
-        time = num.asarray(time)
+        time = self._asArray(time)
         #Magnitude errors
-        valerrp = num.asarray(valerrp)
-        valerrm = num.asarray(valerrm)
+        valerrp = self._asArray(valerrp)
+        valerrm = self._asArray(valerrm)
         self._magerrbright = valerrp
         self._magerrdim = valerrm
         self._mag = values
@@ -63,10 +85,32 @@ class TimeSeriesMag:
         self._period = period
         #Offset of time series in days
         self._offset = offset
+        #Magnitude shift applied to the spline magnitudes, see shift
+        self._magshift = 0.
         #Check if magnitude and time arrays are consistent
         if(self._mag.any() and self._time.any()):
             assert len(self._mag) == len(self._time), "Magnitude array and time array must be the same length"
 
+    @staticmethod
+    def _asArray(values):
+        if values is None:
+            return _noneArray
+        return num.asarray(values)
+
+    def __getstate__(self):
+        #Pickle a scipy spline as its knots, coefficients and degree, which evaluate identically
+        state = dict([(name, getattr(self, name)) for name in self.__slots__])
+        spline = state.get('_spline')
+        if spline is not None and not isinstance(spline, (SplineTck, TabulatedSpline)):
+            if spline not in _pickledSplines:
+                _pickledSplines[spline] = SplineTck(*splineToTck(spline))
+            state['_spline'] = _pickledSplines[spline]
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
     def evaluate(self, epochs):
         return self.getSplineMags(epochs)
 
@@ -74,10 +118,28 @@ class TimeSeriesMag:
         #Set spline for this time series
         self._spline = makespline(time, flux)
 
+    def tabulate(self, tol, kind='linear'):
+        #Replace the spline of this periodic time series by a TabulatedSpline deviating from it by at most
+        #tol magnitudes.  Returns the maximum deviation reached.
+        assert self._spline is not None, "Spline was not calculated on this time series"
+        assert self._period is not None and self._period > 0, "Only periodic time series may be tabulated"
+        self._spline = TabulatedSpline(self._spline, tol, kind, metric=lambda flux: _mutils.toMagArr(flux, self._filter))
+        return self._spline.maxerr
+
     def getSpline(self):
         #Get spline for this time series
         return self._spline
 
+    def getTck(self):
+        #Get (knots, coefficients, degree) of the spline of this time series, None if not calculated
+        if self._spline is None or isinstance(self._spline, TabulatedSpline):
+            return None
+        return splineToTck(self._spline)
+
+    def setTck(self, t, c, k):
+        #Set the spline of this time series from knots, coefficients and degree, as returned by getTck
+        self._spline = SplineTck(t, c, k)
+
     def getTime(self):
         #Get time array for this time series
         return self._time 
@@ -99,7 +161,7 @@ class TimeSeriesMag:
         #Previous versions of this code have used Pogson magnitudes.  We have changed to 
         #ASINH mags since these behave well at negative fluxes.
         #See http://www.sdss.org/DR7/algorithms/fluxcal.html#counts2mag for a description and refs.
-        fluxs = MagUtils().toFluxArr(self._mag, self._filter)
+        fluxs = _mutils.toFluxArr(self._mag, self._filter)
         return fluxs
 
     def getM5(self):
@@ -115,21 +177,134 @@ class TimeSeriesMag:
             warn("getPeriod called before initialization of the period. TimeSeries object resulting from calls to LightCurve.Realize() have no period since they represent observational data.")
         return self._period
   
+    def isPeriodic(self):
+        #True if this time series repeats with its period
+        return self._period is not None and self._period > 0
+
+    def getWindow(self):
+        #Interval of dates (offset applied) outside of which a non periodic time series has no flux,
+        #None for a periodic time series or one without a spline
+        if self.isPeriodic() or self._spline is None:
+            return None
+        return (self._offset + self._time[0], self._offset + self._time[-1])
+
+    def getMagShift(self):
+        #Get the magnitude shift applied to the spline magnitudes of this time series
+        return self._magshift
+
+    def shift(self, offset=None, magshift=0.):
+        '''
+        Return a copy of this time series at another offset and shifted in magnitude.  The copy shares
+        the spline and arrays of this time series, so no spline is fit.
+        Inputs:
+        offset -- offset in days of the copy, that of this time series if None
+        magshift -- magnitudes added to the spline magnitudes of the copy (e.g. a distance modulus);
+                    the zero flux of a non periodic time series outside its window is not shifted
+        '''
+        if offset is None:
+            offset = self._offset
+        ts = TimeSeriesMag(self._time, self._mag, self._magerrbright, self._magerrdim, self._filter, calcspline = False,
+                           period = self._period, offset = offset, ra = self._ra, dec = self._dec, m5 = self._m5s)
+        ts._spline = self._spline
+        ts._magshift = self._magshift + magshift
+        return ts
+
+    def expand(self, offsets=None, magshifts=0.):
+        '''
+        Return a list of copies of this time series, see shift, one per element of offsets and magshifts
+        broadcast against each other.  LightCurve.Realize evaluates copies sharing a spline together.
+        '''
+        offsets, magshifts = self._broadcastShifts(offsets, magshifts)
+        return [self.shift(o, m) for o, m in zip(offsets, magshifts)]
+
+    def getOffset(self):
+        #Get offset in days of this time series
+        return self._offset
+
+    def getFamilyKey(self):
+        #Time series sharing a spline are evaluated together by evaluateFamily
+        if self._spline is None:
+            return None
+        return ('spline', id(self._spline))
+
+    def evaluateFamily(self, members, dates, filt=None):
+        ''' Evaluate time series sharing this spline at dates; returns the magnitudes and the inside mask '''
+        return self.evaluateMany(dates, [ts.getOffset() for ts in members], [ts.getMagShift() for ts in members],
+                                 inside = True)
+
+    def _broadcastShifts(self, offsets, magshifts):
+        if offsets is None:
+            offsets = self._offset
+        if magshifts is None:
+            magshifts = self._magshift
+        return num.broadcast_arrays(num.atleast_1d(num.asarray(offsets, dtype=float)),
+                                    num.atleast_1d(num.asarray(magshifts, dtype=float)))
+
+    def evaluateMany(self, dates, offsets=None, magshifts=None, inside=False):
+        '''
+        Evaluate the spline magnitudes of this time series at many offsets and magnitude shifts
+        in one broadcast computation.
+        Inputs:
+        dates -- array of dates in days
+        offsets -- array of offsets in days, the offset of this time series if None
+        magshifts -- array of magnitude shifts added to the spline magnitudes, broadcast against offsets;
+                     the magnitude shift of this time series if None
+        inside -- True to also return the mask of the dates inside the window of each offset
+        Return:
+        (n, len(dates)) array of magnitudes, n being the broadcast length of offsets and magshifts,
+        and the (n, len(dates)) mask if inside is True
+        '''
+        assert self._spline is not None, "Spline was not calculated on this time series"
+        offsets, magshifts = self._broadcastShifts(offsets, magshifts)
+        dates = num.asarray(dates, dtype=float)
+        x = dates[num.newaxis,:] - offsets[:,num.newaxis]
+        if self.isPeriodic():
+            #Fraction of period at each date, as evalper computes it
+            period = float(self._period)
+            x %= period
+            x /= period
+            mags = num.asarray(self._spline(x.ravel())).reshape(x.shape)
+            mask = num.ones(x.shape, dtype=bool)
+        else:
+            #No flux outside the range of the time points, as evalnonper
+            mask = (x >= self._time[0]) & (x <= self._time[-1])
+            mags = num.zeros(x.shape)
+            mags[mask] = self._spline(x[mask])
+        _mutils.toMagArr(mags, self._filter, out=mags)
+        mags += num.where(mask, magshifts[:,num.newaxis], 0.)
+        if inside:
+            return mags, mask
+        return mags
+
     def getSplineMags(self, dates):
         if(self._spline == None):
             print "Warning: Spline was not calculated on this time series"
             mags = None
         else:
-            dates = num.asarray(dates)
-            fluxs = num.asarray(evalper(self._spline, dates, self._offset, self._period))
-            mags = MagUtils().toMagArr(fluxs, self._filter)
+            mags = _mutils.toMagArr(self._evaluateFlux(dates), self._filter)
+            if self._magshift != 0.:
+                if self.isPeriodic():
+                    mags += self._magshift
+                else:
+                    #The zero flux outside the window is not shifted
+                    dates = num.asarray(dates) - self._offset
+                    mags += num.where((dates >= self._time[0]) & (dates <= self._time[-1]), self._magshift, 0.)
         return mags
 
     def getSplineFlux(self, dates):
         if(self._spline == None):
             print "Warning: Spline was not calculated on this time series"
-            mags = None
+            fluxs = None
+        elif self._magshift != 0.:
+            fluxs = _mutils.toFluxArr(self.getSplineMags(dates), self._filter)
         else:
-            dates = num.asarray(dates)
-            fluxs = num.asarray(evalper(self._spline, dates, self._offset, self._period))
-        return fluxs 
+            fluxs = self._evaluateFlux(dates)
+        return fluxs
+
+    def _evaluateFlux(self, dates):
+        #Spline flux at dates, without the magnitude shift
+        dates = num.asarray(dates)
+        if self.isPeriodic():
+            return num.asarray(evalper(self._spline, dates, self._offset, self._period))
+        #No flux outside the range of the time points; the spline is only evaluated inside it
+        return num.asarray(evalnonper(self._spline, self._time, dates, self._offset, 0.))
@@ -1,8 +1,21 @@
 from LightCurve import *
 from DB import *
+from PointingStore import *
+from FieldIndex import *
+from CadenceCache import *
+from FieldSetCache import *
+from RealizationTable import *
+from NoiseStreams import *
+from RealizationJob import *
+from RealizationStore import *
+from TemplateLibrary import *
+from TemplateCache import *
 from TimeSeriesMag import *
 from MagUtils import *
 from Interpolate import makespline
 from Interpolate import evalper
 from Interpolate import evalnonper
 from Interpolate import splineinterp 
+from Interpolate import setSplineCache
+from Interpolate import SplineCache
+from Interpolate import SplineTck
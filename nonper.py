@@ -11,21 +11,11 @@ dmod = 20 # 20th mag at peak
 t_offset = 52000 # realize with time offset of 52000 days to put it in the survey
 
 infile = 'sn1a_lc.v1.1.dat'
-Bfs = []
-Vfs = []
-err = []
-Bms = []
-Vms = []
-time = []
-for line in open(infile).readlines():
-
-     t,U,B,V,R,I,J,H,K = map(float, line.split())
-
-
-     err.append(1.0)
-     Bms.append(B + dmod)
-     Vms.append(V + dmod)
-     time.append(t)
+#Columns of the template, read from its compiled binary file if fresh (see interp.compileTemplate)
+time,U,B,V,R,I,J,H,K = interp.loadTemplate(infile).data
+err = num.ones(len(time))
+Bms = B + dmod
+Vms = V + dmod
 
 tms = []
 #list of TimeSeries sending mags
@@ -48,7 +38,7 @@ dec.append(60)
 lc = interp.LightCurve(tms, isper)
 #Available versions are: OpSim3_61, opsim1_29, opsim5_72, and cronos92
 #If you wish to use the older version of the catalog, set the version to "Cronos92".
-#Dithering can currently only be done on the older version.
+#Dithering (doDith = True) may be used with any version.
 #NOTE:  If resultant mag = -66 it was outside the original lightcurve
 #NOTE:  If resultant magerr = -9999 the m5 was brighter than the interpolated magnitude
 #in this case, the m5 is returned instead of the interpolated magnitude
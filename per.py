@@ -9,19 +9,10 @@ t_offset = 0
 
 
 infile = 'periodic.dat'
-rfs = []
-err = []
-rms = []
-time = []
-for line in open(infile).readlines():
-
-     t,rflux = map(float, line.split())
-
-
-     rmag = -2.5*(math.log(rflux)/math.log(10)) + 35 
-     err.append(1.0)
-     rms.append(rmag)
-     time.append(t)
+#Columns of the template, read from its compiled binary file if fresh (see interp.compileTemplate)
+time, rflux = interp.loadTemplate(infile).data
+rms = -2.5*num.log10(rflux) + 35
+err = num.ones(len(time))
 
 tms = []
 ts = interp.TimeSeriesMag(time, rms, err, err, 'g', period = xp, offset = t_offset);
@@ -43,7 +34,7 @@ lc = interp.LightCurve(tms, isper)
 lcn = lc.Realize(ra, dec, doAddErr = True, doDith = False, version="OpSim3_61")
 #Available versions are: OpSim3_61, opsim1_29, opsim5_72, and cronos92
 #If you wish to use the older version of the catalog, set the version to "Cronos92".
-#Dithering can currently only be done on the older version.
+#Dithering (doDith = True) may be used with any version.
 #NOTE:  If resultant magerr = -9999 the m5 was brighter than the interpolated magnitude
 timeres = []
 for i in range(len(ra)):